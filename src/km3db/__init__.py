@@ -1,3 +1,4 @@
 from .version import *
-from .core import DBManager, AuthenticationError
+from .core import DBManager, AuthenticationError, RetryPolicy
 from .tools import StreamDS, CLBMap, APIv2
+from .aio import AsyncDBManager, AsyncStreamDS, AsyncAPIv2, AsyncJSONDS
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# Filename: aio.py
+"""
+asyncio counterparts of the database access classes.
+
+The requests are carried out by the blocking clients (`DBManager`,
+`StreamDS`, `APIv2` and `JSONDS`) in a thread pool, so the cookie/session
+handling, the retry logic and the keep-alive connections are shared with
+them. The number of in-flight queries is bounded by a semaphore, which allows
+a single event loop to fan out hundreds of queries. The connection pool of
+the shared `DBManager` is enlarged to keep a connection for each of them.
+
+Example::
+
+    async def main():
+        sds = km3db.AsyncStreamDS(container="nt")
+        runs = await asyncio.gather(
+            *[sds.get("runs", detid=det_id) for det_id in (49, 133, 160)]
+        )
+
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import inspect
+
+import km3db.core
+import km3db.tools
+
+
+class _AsyncExecutor:
+    """Runs blocking calls in a thread pool with bounded concurrency"""
+
+    def __init__(self, max_concurrency=32):
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="km3db"
+        )
+        self._semaphore = None
+        self._loop = None
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+
+    def close(self):
+        """Shut down the thread pool"""
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class AsyncDBManager(_AsyncExecutor):
+    """asyncio counterpart of `DBManager`
+
+    Parameters
+    ==========
+    url: str (optional)
+      The URL of the database web API
+    network_class: str or None (optional)
+      The network class ("B" or "C") when requesting a new session cookie.
+    max_concurrency: int (optional)
+      The maximum number of queries in flight.
+    shared: bool (optional)
+      Use the process-wide `DBManager` (default), which is shared with the
+      blocking clients, otherwise a private one which is closed by `close()`.
+    """
+
+    def __init__(self, url=None, network_class=None, max_concurrency=32, shared=True):
+        super().__init__(max_concurrency=max_concurrency)
+        if shared:
+            self.db = km3db.core.get_db_manager(
+                url=url, network_class=network_class, pool_size=max_concurrency
+            )
+        else:
+            self.db = km3db.core.DBManager(
+                url=url, network_class=network_class, pool_size=max_concurrency
+            )
+        self._owns_db = not shared
+
+    async def get(self, url, default=None, retries=None, binary=False, **kwargs):
+        "Get HTML content, see `DBManager.get`"
+        return await self._run(
+            self.db.get, url, default=default, retries=retries, binary=binary, **kwargs
+        )
+
+    def close(self):
+        super().close()
+        if self._owns_db:
+            self.db.close()
+
+
+class AsyncStreamDS(_AsyncExecutor):
+    """asyncio counterpart of `StreamDS`
+
+    The stream functions (e.g. ``await sds.runs(detid=49)``) and the other
+    methods of `StreamDS` (e.g. ``await sds.last_run(49)``) are available
+    as coroutine functions. If the stream catalog has not been loaded yet,
+    it is retrieved in the thread pool when a stream function is called.
+    Other attributes (e.g. ``sds.max_workers``) are returned as they are.
+
+    Parameters
+    ==========
+    url: str (optional)
+      The URL of the database web API
+    container: str or None (optional)
+      The default containertype when returning data, see `StreamDS`.
+    max_concurrency: int (optional)
+      The maximum number of queries in flight.
+    """
+
+    def __init__(self, url=None, container=None, max_concurrency=32):
+        super().__init__(max_concurrency=max_concurrency)
+        km3db.core.get_db_manager(url=url, pool_size=max_concurrency)
+        self._sds = km3db.tools.StreamDS(url=url, container=container)
+
+    @property
+    def streams(self):
+        return self._sds.streams
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        if self._sds._streams is None and not _is_attribute(self._sds, attr):
+            return _lazy_coroutine_function(self._run, self._sds, attr)
+        value = getattr(self._sds, attr)
+        if not callable(value):
+            return value
+        return _coroutine_function(self._run, value, value)
+
+    async def get(self, stream, fmt="txt", container=None, renamemap=None, **kwargs):
+        """Retrieve the data for a given stream, see `StreamDS.get`"""
+        return await self._run(
+            self._sds.get,
+            stream,
+            fmt=fmt,
+            container=container,
+            renamemap=renamemap,
+            **kwargs,
+        )
+
+    async def iter(self, stream, **kwargs):
+        """Iterate over the rows of a given stream, see `StreamDS.iter`
+
+        The rows are parsed in the thread pool while they are retrieved.
+        """
+        async for item in _iterate(self._run, self._sds.iter(stream, **kwargs)):
+            yield item
+
+
+class AsyncAPIv2(_AsyncExecutor):
+    """asyncio counterpart of `APIv2`
+
+    The endpoints (e.g. ``await api.RunCalibration(DetOId=..., Run=...)``)
+    and the other methods of `APIv2` (e.g. ``await api.batch(...)``) are
+    available as coroutine functions. If the endpoint catalog has not been
+    loaded yet, it is retrieved in the thread pool when an endpoint is called.
+    Other attributes (e.g. ``api.max_workers``) are returned as they are.
+
+    Parameters
+    ==========
+    url: str (optional)
+      The URL of the database web API
+    max_concurrency: int (optional)
+      The maximum number of queries in flight.
+    """
+
+    def __init__(self, url=None, max_concurrency=32):
+        super().__init__(max_concurrency=max_concurrency)
+        km3db.core.get_db_manager(url=url, pool_size=max_concurrency)
+        self._api = km3db.tools.APIv2(url=url)
+
+    @property
+    def endpoints(self):
+        return self._api.endpoints
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        if self._api._endpoints is None and not _is_attribute(self._api, attr):
+            return _lazy_coroutine_function(self._run, self._api, attr)
+        value = getattr(self._api, attr)
+        if not callable(value):
+            return value
+        return _coroutine_function(self._run, value, value)
+
+    async def iter(self, endpoint, **kwargs):
+        """Iterate over the results of an endpoint, see `APIv2.iter`
+
+        The response is parsed in the thread pool while it is retrieved.
+        """
+        async for item in _iterate(self._run, self._api.iter(endpoint, **kwargs)):
+            yield item
+
+
+class AsyncJSONDS(_AsyncExecutor):
+    """asyncio counterpart of `JSONDS`
+
+    Parameters
+    ==========
+    url: str (optional)
+      The URL of the database web API
+    max_concurrency: int (optional)
+      The maximum number of queries in flight.
+    """
+
+    def __init__(self, url=None, max_concurrency=32):
+        super().__init__(max_concurrency=max_concurrency)
+        km3db.core.get_db_manager(url=url, pool_size=max_concurrency)
+        self._jsonds = km3db.tools.JSONDS(url=url)
+
+    async def get(self, url, deadline=None):
+        "Get JSON-type content from the url, see `JSONDS.get`"
+        return await self._run(self._jsonds.get, url, deadline=deadline)
+
+    async def iter(self, url, batch_size=None, chunk_size=2**16, deadline=None):
+        """Iterate over JSON-type content from the url, see `JSONDS.iter`
+
+        The response is parsed in the thread pool while it is retrieved.
+        """
+        iterator = self._jsonds.iter(
+            url, batch_size=batch_size, chunk_size=chunk_size, deadline=deadline
+        )
+        async for item in _iterate(self._run, iterator):
+            yield item
+
+
+def _is_attribute(obj, attr):
+    """Whether `attr` is an attribute of `obj` (not a stream or an endpoint)"""
+    return attr in vars(obj) or hasattr(type(obj), attr)
+
+
+def _coroutine_function(run, func, template):
+    """Create a coroutine function which runs `func` via `run`
+
+    The docstring and signature are taken from `template`.
+    """
+
+    async def coro(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    coro.__doc__ = template.__doc__
+    coro.__signature__ = inspect.signature(template)
+    return coro
+
+
+def _lazy_coroutine_function(run, obj, attr):
+    """Create a coroutine function for the stream or endpoint `attr` of `obj`
+
+    The catalog is loaded via `run` on the first call, an `AttributeError` is
+    raised if `attr` is not in it.
+    """
+
+    async def coro(*args, **kwargs):
+        func = await run(getattr, obj, attr)
+        return await run(func, *args, **kwargs)
+
+    coro.__doc__ = "Call '{}', see `{}`".format(attr, type(obj).__name__)
+    return coro
+
+
+async def _iterate(run, iterator):
+    """Iterate asynchronously over a blocking iterator, advanced via `run`"""
+    done = object()
+    while True:
+        item = await run(next, iterator, done)
+        if item is done:
+            break
+        yield item
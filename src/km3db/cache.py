@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# Filename: cache.py
+"""
+Caching facilities.
+
+"""
+from collections import namedtuple, OrderedDict
+from functools import partial, wraps
+from hashlib import sha256
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+
+from km3db.logger import log
+
+
+CacheInfo = namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+
+def memoize(func=None, maxsize=128, ttl=None, ignore=()):
+    """Memoize a function with LRU eviction and an optional time-to-live
+
+    Can be used as ``@memoize`` or ``@memoize(maxsize=256, ttl=3600)``. The
+    cache is thread-safe and the decorated function provides ``cache_info()``
+    and ``cache_clear()``, just like `functools.lru_cache`. Notice that
+    mutable return values (e.g. lists) are shared between the callers.
+
+    Parameters
+    ==========
+    maxsize: int or None
+      The maximum number of cached calls, None means unbounded.
+    ttl: float or None
+      The time in seconds after which a cached result expires.
+    ignore: tuple(str)
+      Keyword arguments which are not part of the cache key (e.g. a
+      `deadline`), they are only passed on when the function is called.
+    """
+    if func is None:
+        return partial(memoize, maxsize=maxsize, ttl=ttl, ignore=ignore)
+
+    cache = OrderedDict()
+    lock = threading.Lock()
+    stats = [0, 0]  # hits, misses
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = args
+        items = [item for item in kwargs.items() if item[0] not in ignore]
+        if items:
+            key += (_kwargs_mark,) + tuple(sorted(items))
+        with lock:
+            try:
+                value, expires = cache[key]
+            except KeyError:
+                pass
+            else:
+                if expires is None or expires > time.monotonic():
+                    cache.move_to_end(key)
+                    stats[0] += 1
+                    return value
+                del cache[key]
+            stats[1] += 1
+        value = func(*args, **kwargs)
+        with lock:
+            cache[key] = (value, None if ttl is None else time.monotonic() + ttl)
+            cache.move_to_end(key)
+            if maxsize is not None:
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+        return value
+
+    def cache_info():
+        with lock:
+            return CacheInfo(stats[0], stats[1], maxsize, len(cache))
+
+    def cache_clear():
+        with lock:
+            cache.clear()
+            stats[:] = [0, 0]
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
+
+_kwargs_mark = object()
+
+
+def cache_dir():
+    """The default cache directory
+
+    It can be set via ``$KM3DB_CACHE_DIR`` and defaults to ``km3db`` in the
+    user's cache directory (``$XDG_CACHE_HOME`` or ``~/.cache``).
+    """
+    path = os.getenv("KM3DB_CACHE_DIR")
+    if path is None:
+        path = os.path.join(
+            os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "km3db"
+        )
+    return path
+
+
+class DiskCache:
+    """A size-bounded key-value store on disk, safe to share between processes
+
+    Each entry is pickled into its own file. Files are written to a temporary
+    file first and then atomically renamed, so concurrent readers never see
+    partially written entries. The modification time of an entry is updated
+    on each hit and the least recently used entries are evicted once the
+    total size exceeds `max_bytes`.
+
+    The total size is tracked by a running estimate of each instance, so the
+    directory is only scanned when the estimate exceeds `max_bytes` or when
+    the last scan is older than `scan_interval` seconds (to account for the
+    entries written by other processes).
+
+    Parameters
+    ==========
+    path: str or None (optional)
+      The cache directory, defaults to a subfolder of `cache_dir()`.
+    max_bytes: int (optional)
+      The maximum total size of all entries in bytes.
+    """
+
+    name = "default"
+    suffix = ".pkl"
+    scan_interval = 60
+
+    def __init__(self, path=None, max_bytes=500 * 1024**2):
+        self.path = os.path.join(cache_dir(), self.name) if path is None else path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # the estimated total size, None until scanned
+        self._scanned = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return 0
+        return sum(name.endswith(self.suffix) for name in names)
+
+    def _filename(self, key):
+        return os.path.join(
+            self.path, sha256(key.encode("utf-8")).hexdigest() + self.suffix
+        )
+
+    def _entries(self):
+        """A list of (mtime, size, filename) of the cache entries"""
+        entries = []
+        try:
+            it = os.scandir(self.path)
+        except FileNotFoundError:
+            return entries
+        with it:
+            for entry in it:
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get(self, key, default=None):
+        """Return the value stored for `key` or `default` if there is none"""
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as fobj:
+                _key, expires, value = pickle.load(fobj)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            self.misses += 1
+            return default
+        if _key != key:
+            self.misses += 1
+            return default
+        if expires is not None and expires < time.time():
+            self._remove(filename)
+            self.misses += 1
+            return default
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store a value with an optional time-to-live in seconds"""
+        expires = None if ttl is None else time.time() + ttl
+        data = pickle.dumps((key, expires, value), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            log.debug("Not caching '%s', it exceeds the size limit", key)
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp_filename = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as fobj:
+                    fobj.write(data)
+                os.replace(tmp_filename, self._filename(key))
+            except BaseException:
+                self._remove(tmp_filename)
+                raise
+        except OSError as e:
+            log.warning("Could not write to the cache at '%s': %s", self.path, e)
+            return
+        self._grow(len(data))
+
+    def delete(self, key):
+        """Remove the entry for `key`"""
+        self._remove(self._filename(key))
+
+    def clear(self):
+        """Remove all entries and reset the statistics"""
+        for _, _, filename in self._entries():
+            self._remove(filename)
+        self.hits = self.misses = 0
+        with self._lock:
+            self._size = None
+
+    def cache_info(self):
+        """Hits, misses, maximum and current size in bytes"""
+        currsize = sum(size for _, size, _ in self._entries())
+        with self._lock:
+            self._size, self._scanned = currsize, time.time()
+        return CacheInfo(self.hits, self.misses, self.max_bytes, currsize)
+
+    def _grow(self, nbytes):
+        """Add a new entry to the size estimate and evict if needed
+
+        Replaced and removed entries are not subtracted, so the estimate only
+        errs on the high side until the next scan.
+        """
+        with self._lock:
+            recent = time.time() - self._scanned < self.scan_interval
+            if self._size is not None and recent:
+                self._size += nbytes
+                if self._size <= self.max_bytes:
+                    return
+            self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until within the size limit"""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, filename in sorted(entries):
+                self._remove(filename)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        self._size, self._scanned = total, time.time()
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+class ResponseCache(DiskCache):
+    """A persistent cache of database responses for `DBManager`
+
+    The responses are keyed by the base URL of the server, the canonicalised
+    URL (query parameters are sorted) and whether they were requested as
+    binary. The time-to-live of an
+    entry is determined by the first pattern in `ttls` which matches the URL
+    (``re.search``) and `default_ttl` otherwise. A TTL of ``None`` means the
+    entry never expires and ``0`` disables caching for matching URLs.
+
+    Example::
+
+        cache = ResponseCache(ttls=[
+            (r"^detx/", None),  # DETX for fixed calibration IDs
+            (r"^streamds/detectors\\.", 3600),
+        ])
+        db = DBManager(cache=cache)
+        ...
+        print(cache.cache_info())
+
+    Parameters
+    ==========
+    path: str or None (optional)
+      The cache directory, defaults to a subfolder of `cache_dir()`.
+    max_bytes: int (optional)
+      The maximum total size of all entries in bytes.
+    ttls: list((str, float or None)) or None (optional)
+      A list of (URL pattern, TTL in seconds) pairs.
+    default_ttl: float or None (optional)
+      The TTL in seconds for URLs which match none of the patterns.
+    """
+
+    name = "responses"
+
+    def __init__(self, path=None, max_bytes=500 * 1024**2, ttls=None, default_ttl=600):
+        super().__init__(path=path, max_bytes=max_bytes)
+        self.ttls = [(re.compile(p), ttl) for p, ttl in (ttls or [])]
+        self.default_ttl = default_ttl
+
+    def ttl(self, url):
+        """The TTL for a given URL"""
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def lookup(self, url, binary=False, base_url=""):
+        """Return the cached raw content for `url` or None
+
+        The entries are kept per `base_url` (the server), the TTL patterns
+        are matched against `url` only.
+        """
+        if self.ttl(url) == 0:
+            return None
+        return self.get(self._key(url, binary, base_url))
+
+    def store(self, url, content, binary=False, base_url=""):
+        """Store the raw content for `url`, see `lookup`"""
+        ttl = self.ttl(url)
+        if ttl == 0:
+            return
+        self.set(self._key(url, binary, base_url), content, ttl=ttl)
+
+    @staticmethod
+    def _key(url, binary, base_url):
+        return "{}:{}/{}".format(int(binary), base_url.rstrip("/"), url)
+
+
+class ResultCache(DiskCache):
+    """A persistent cache of `StreamDS` results
+
+    The raw database output is stored and converted to the requested
+    container on each hit, exactly like a freshly retrieved result. Results
+    which cannot change anymore, e.g. for runs before the last run of a
+    detector, are kept until they are evicted. All other results expire after
+    `open_ttl` seconds.
+
+    Parameters
+    ==========
+    path: str or None (optional)
+      The cache directory, defaults to a subfolder of `cache_dir()`.
+    max_bytes: int (optional)
+      The maximum total size of all entries in bytes.
+    open_ttl: float (optional)
+      The TTL in seconds for results which may still change.
+    """
+
+    name = "results"
+
+    def __init__(self, path=None, max_bytes=1024**3, open_ttl=600):
+        super().__init__(path=path, max_bytes=max_bytes)
+        self.open_ttl = open_ttl
+
+
+class MirrorCache(DiskCache):
+    """The on-disk storage of `km3db.tools.RunsMirror`"""
+
+    name = "mirror"
+
+    def __init__(self, path=None, max_bytes=1024**3):
+        super().__init__(path=path, max_bytes=max_bytes)
+
+
+class CatalogCache(DiskCache):
+    """The on-disk cache of the stream and endpoint catalogs"""
+
+    name = "catalogs"
+
+    def __init__(self, path=None, max_bytes=50 * 1024**2):
+        super().__init__(path=path, max_bytes=max_bytes)
+
+
+class SchemaCache(DiskCache):
+    """The on-disk cache of the learned `StreamDS` schemas for pandas"""
+
+    name = "schemas"
+
+    def __init__(self, path=None, max_bytes=10 * 1024**2):
+        super().__init__(path=path, max_bytes=max_bytes)
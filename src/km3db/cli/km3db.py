@@ -26,7 +26,7 @@ from docopt import docopt
 
 def main():
     args = docopt(__doc__, version=km3db.version)
-    db = km3db.DBManager()
+    db = km3db.core.get_db_manager()
     url = args["URL"]
 
     is_binary = args["-b"]
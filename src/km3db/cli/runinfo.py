@@ -3,12 +3,14 @@
 Prints the run table for a given detector ID.
 
 Usage:
-    runinfo DET_ID RUN
+    runinfo [--refresh] DET_ID RUN
     runinfo (-h | --help)
     runinfo --version
 
 Options:
     -h --help           Show this screen.
+    --refresh           Retrieve all runs again instead of updating the
+                        local runs mirror.
     DET_ID              Detector ID (eg. D_ARCA001).
     RUN                 Run number.
 
@@ -19,8 +21,11 @@ import km3db
 log = km3db.logger.log
 
 
-def runinfo(run_id, det_id):
-    runs = km3db.StreamDS(container="nt").get("runs", detid=det_id)
+def runinfo(run_id, det_id, refresh=False):
+    sds = km3db.StreamDS(container="records", runs_mirror=True)
+    if refresh:
+        sds.runs_mirror.sync(det_id, refresh=True)
+    runs = sds.get("runs", detid=det_id)
 
     if runs is None:
         log.error("No runs found for detector ID {}".format(det_id))
@@ -72,4 +77,4 @@ def main():
 
     args = docopt(__doc__, version=km3db.version)
 
-    runinfo(int(args["RUN"]), int(args["DET_ID"]))
+    runinfo(int(args["RUN"]), int(args["DET_ID"]), refresh=args["--refresh"])
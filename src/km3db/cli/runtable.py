@@ -14,10 +14,12 @@ Options:
     -r FROM_RUN-TO_RUN  Range of runs (example: 3100-3200).
     -t TARGET           Job target (run/on/off)
     -s REGEX            Regular expression to filter the runsetup name/id.
+    --refresh           Retrieve all runs again if the local runs mirror is used.
     DET_ID              Detector ID (eg. D_ARCA001).
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import re
 import sys
 
@@ -33,20 +35,58 @@ __email__ = "tgal@km3net.de"
 __status__ = "Development"
 
 
+# the maximum number of runs which are retrieved one by one
+MAX_WINDOW = 100
+
+
 def runtable(
-    det_id, n=5, run_range=None, target=None, compact=False, sep="\t", regex=None
+    det_id,
+    n=5,
+    run_range=None,
+    target=None,
+    compact=False,
+    sep="\t",
+    regex=None,
+    refresh=False,
 ):
-    """Print the run table of the last `n` runs for given detector"""
-    runs = km3db.StreamDS(container="nt").get("runs", detid=det_id)
-
+    """Print the run table of the last `n` runs for given detector
+
+    If the requested runs can be narrowed down to a window of at most
+    `MAX_WINDOW` run numbers (via `run_range` or the last run of the
+    detector and `n`), only these runs are retrieved from the database.
+    Otherwise the runs are taken from the local runs mirror, which is
+    retrieved completely again if `refresh` is True. In both cases
+    the rows are the records of `StreamDS.get("runs", container="records")`.
+    """
+    sds = km3db.StreamDS(container="records")
     if run_range is not None:
         try:
             from_run, to_run = [int(r) for r in run_range.split("-")]
         except ValueError:
             log.critical("Please specify a valid range (e.g. 3100-3200)!")
             raise SystemExit
-        else:
-            runs = [r for r in runs if from_run <= r.run <= to_run]
+
+    window = None
+    if run_range is not None:
+        window = range(from_run, to_run + 1)
+    elif n is not None and target is None and regex is None:
+        last_run = sds.last_run(det_id, cached=False)
+        if last_run is not None:
+            window = range(max(1, last_run - n + 1), last_run + 1)
+
+    runs = None
+    if window is not None and len(window) <= MAX_WINDOW:
+        runs = get_runs(det_id, window, target=target, sds=sds)
+        if run_range is None and len(runs) < n:
+            runs = None  # there are gaps in the run numbers
+    if runs is None:
+        sds.runs_mirror = km3db.tools.RunsMirror(sds)
+        if refresh:
+            sds.runs_mirror.sync(det_id, refresh=True)
+        runs = sds.get("runs", detid=det_id) or []
+
+    if run_range is not None:
+        runs = [r for r in runs if from_run <= r.run <= to_run]
 
     if regex is not None:
         try:
@@ -89,6 +129,21 @@ def runtable(
         print(lineformatter(entry))
 
 
+def get_runs(det_id, window, target=None, sds=None):
+    """Retrieve the given runs of a detector, optionally for a job target"""
+    if sds is None:
+        sds = km3db.StreamDS(container="records")
+    selectors = dict(detid=det_id)
+    if target is not None:
+        selectors["jobtarget"] = target.capitalize()
+    sds._db.grow_pool(sds.max_workers)
+    with ThreadPoolExecutor(max_workers=sds.max_workers) as executor:
+        results = executor.map(
+            lambda run: sds.get("runs", **selectors, run=run), window
+        )
+        return [run for result in results if result for run in result]
+
+
 def main():
     from docopt import docopt
 
@@ -106,4 +161,5 @@ def main():
         target=args["-t"],
         regex=args["-s"],
         compact=args["-c"],
+        refresh=args["--refresh"],
     )
@@ -16,7 +16,8 @@ Options:
     PARAMETERS  List of parameters separated by space (e.g. detid=29).
     CSV_FILE    Whitespace separated data for the runsummary tables.
     -f FORMAT   Usually 'txt' for ASCII or 'text' for UTF-8 [default: txt].
-    -o OUTFILE  Output file: supported formats '.csv' and '.h5'.
+    -o OUTFILE  Output file: supported formats '.csv', '.h5', '.parquet' and
+                '.feather' (the latter two require pyarrow).
     -g COLUMN   Group dataset by the name of the given row when writing HDF5.
     -q          Test run! When uploading, a TEST_ prefix will be added to the data.
     -x          Do not verify the SSL certificate.
@@ -24,13 +25,14 @@ Options:
 
 """
 import getpass
-import json
 import logging
+import math
 import os
 import requests
 
 import km3db
 import km3db.extras
+import km3db.jsoncodec
 from docopt import docopt
 
 log = km3db.logger.get_logger("streamds")
@@ -71,7 +73,10 @@ def get_data(stream, parameters, fmt, outfile=None, groupby=None):
                 continue
             key, value = parameter.split("=")
             params[key] = value
-    data = sds.get(stream, fmt, **params)
+    container = None
+    if outfile is not None and outfile.endswith((".parquet", ".feather")):
+        container = "arrow"
+    data = sds.get(stream, fmt, container=container, **params)
     if data is not None:
         if outfile is not None:
             write_output(outfile, stream, data, groupby)
@@ -85,7 +90,7 @@ def get_data(stream, parameters, fmt, outfile=None, groupby=None):
 
 
 def write_output(outfile, stream, data, groupby=None):
-    """Writes the DB output to a file (HDF5 or CSV)"""
+    """Writes the DB output to a file (HDF5, CSV, Parquet or Feather)"""
     _, ext = os.path.splitext(outfile)
 
     if ext == ".h5":
@@ -94,6 +99,9 @@ def write_output(outfile, stream, data, groupby=None):
     if ext == ".csv":
         write_output_csv(outfile, stream, data)
         exit(0)
+    if ext in (".parquet", ".feather"):
+        write_output_arrow(outfile, stream, data)
+        exit(0)
 
     log.error("Unsupported filetype with '{}'".format(ext))
     exit(1)
@@ -132,6 +140,21 @@ def write_output_csv(outfile, stream, data):
     print("Database output written to '{}'.".format(outfile))
 
 
+def write_output_arrow(outfile, stream, data):
+    """Write DB output (raw or a `pyarrow.Table`) to Parquet or Feather"""
+    pyarrow = km3db.extras.pyarrow()
+    table = data if isinstance(data, pyarrow.Table) else km3db.tools.toarrow(data)
+    if outfile.endswith(".parquet"):
+        import pyarrow.parquet
+
+        pyarrow.parquet.write_table(table, outfile)
+    else:
+        import pyarrow.feather
+
+        pyarrow.feather.write_feather(table, outfile)
+    print("Database output written to '{}'.".format(outfile))
+
+
 def available_streams():
     """Show a short list of available streams."""
     sds = km3db.StreamDS()
@@ -218,7 +241,7 @@ def upload_runsummary(csv_filename, testrun=False, verify=False):
 
 
 def _database_upload(data, verify=False, isrunsummarystrings=False):
-    db = km3db.DBManager()  # noqa
+    db = km3db.core.get_db_manager()
 
     print("Requesting database session.")
     session_cookie = db.session_cookie
@@ -233,7 +256,7 @@ def _database_upload(data, verify=False, isrunsummarystrings=False):
     if r.status_code == 200:
         log.debug("POST request status code: {}".format(r.status_code))
         print("Database response:")
-        db_answer = json.loads(r.text)
+        db_answer = km3db.jsoncodec.loads(r.content)
         for key, value in db_answer.items():
             print("  -> {}: {}".format(key, value))
         if db_answer["Result"] == "OK":
@@ -252,7 +275,10 @@ def convert_runsummary_to_json(
     prefix="TEST_",
     isrunsummarystrings=False,
 ):
-    """Convert a Pandas DataFrame with runsummary to JSON for DB upload"""
+    """Convert a Pandas DataFrame with runsummary to JSON (bytes) for DB upload
+
+    NaN and infinite data values are not valid JSON and uploaded as ``null``.
+    """
     data_field = []
     comment += ", by {}".format(getpass.getuser())
     for det_id, det_data in df.groupby("det_id"):
@@ -279,6 +305,8 @@ def convert_runsummary_to_json(
                         except ValueError as e:
                             log.critical("Data values has to be floats!")
                             raise ValueError(e)
+                        if not math.isfinite(data_value):
+                            data_value = None
                     else:
                         data_value = str(data_value)
                     value = {"S": str(getattr(row[1], "source")), "D": data_value}
@@ -286,8 +314,7 @@ def convert_runsummary_to_json(
             for parameter_data in parameter_dict.values():
                 parameters_field.append(parameter_data)
     data_to_upload = {"Comment": comment, "Data": data_field}
-    file_data_to_upload = json.dumps(data_to_upload)
-    return file_data_to_upload
+    return km3db.jsoncodec.dumps(data_to_upload)
 
 
 def main():
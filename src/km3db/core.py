@@ -7,17 +7,24 @@ Database utilities.
 from __future__ import absolute_import, print_function, division
 
 import ssl
+from collections import namedtuple
+import copy
+import functools
 import getpass
+import http.client
 import os
+import random
 import re
 from urllib.error import URLError, HTTPError
 from http.client import IncompleteRead, RemoteDisconnected
 import socket
+import threading
 import pytz
 import time
 from urllib.parse import unquote
 import urllib.request
 
+import km3db.cache
 from km3db.logger import log
 
 
@@ -49,84 +56,576 @@ class AuthenticationError(Exception):
     pass
 
 
+class Timeout(namedtuple("Timeout", "connect read")):
+    """Connect and read timeouts in seconds, None means no timeout
+
+    The read timeout applies to each individual read from the socket.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, timeout):
+        """Create a `Timeout` from a number, a (connect, read) tuple or None"""
+        if isinstance(timeout, cls):
+            return timeout
+        if isinstance(timeout, tuple):
+            return cls(*timeout)
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        return cls(timeout, timeout)
+
+    def clip(self, seconds):
+        """Return the timeouts limited to the given number of seconds"""
+        return Timeout(*(seconds if t is None else min(t, seconds) for t in self))
+
+
+class ConnectionPool:
+    """A thread-safe pool of persistent HTTP/1.1 connections.
+
+    Connections are kept per host after their response has been read
+    completely and are handed out again for subsequent requests, which
+    saves the TCP and TLS handshakes.
+
+    Parameters
+    ==========
+    maxsize: int
+      The maximum number of idle connections kept per host.
+    idle_timeout: float
+      Idle connections older than this (in seconds) are discarded.
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        self._check_fork()
+        with self._lock:
+            return sum(len(conns) for conns in self._idle.values())
+
+    def acquire(self, key, factory):
+        """Return a tuple of (connection, reused) for the given host key
+
+        If no idle connection is available, a new one is created by calling
+        `factory()`.
+        """
+        self._check_fork()
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            now = time.monotonic()
+            while idle:
+                _conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = _conn
+                    break
+                expired.append(_conn)
+        for _conn in expired:
+            _conn.close()
+        if conn is not None:
+            log.debug("Reusing pooled connection to %s", key[1])
+            return conn, True
+        log.debug("Opening new connection to %s", key[1])
+        return factory(), False
+
+    def release(self, key, conn, reusable=True):
+        """Put a connection back into the pool or close it"""
+        self._check_fork()
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.maxsize:
+                    idle.append((conn, time.monotonic()))
+                    return
+        conn.close()
+
+    def _check_fork(self):
+        """Forget the connections of the parent process after a fork"""
+        if self._pid != os.getpid():
+            self._idle = {}
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def clear(self):
+        """Close all idle connections"""
+        self._check_fork()
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+
+class _PooledResponse(http.client.HTTPResponse):
+    """An HTTP response which hands its connection back to the pool once
+    the body has been read completely."""
+
+    _release = None
+    _trailer_read = False
+
+    def _read_and_discard_trailer(self):
+        super()._read_and_discard_trailer()
+        self._trailer_read = True
+
+    def _close_conn(self):
+        super()._close_conn()
+        release, self._release = self._release, None
+        if release is not None:
+            complete = self._trailer_read or self.length == 0 or self._method == "HEAD"
+            release(complete and not self.will_close)
+
+
+class KeepAliveHandler(urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+    """A urllib handler for HTTP(S) which keeps connections alive
+
+    The connections are taken from and returned to a `ConnectionPool`. If
+    the server has dropped a pooled connection in the meantime, the request
+    is transparently sent again over a new connection.
+    """
+
+    def __init__(self, pool=None):
+        urllib.request.HTTPSHandler.__init__(self)
+        self.pool = ConnectionPool() if pool is None else pool
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.host
+        if not host:
+            raise URLError("no host given")
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers["Connection"] = "keep-alive"
+        headers = {name.title(): val for name, val in headers.items()}
+
+        tunnel_headers = {}
+        proxy_auth_hdr = "Proxy-Authorization"
+        if proxy_auth_hdr in headers:
+            tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+        timeout = Timeout.parse(req.timeout)
+
+        def connect():
+            conn = http_class(host, timeout=timeout.connect, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            conn.response_class = _PooledResponse
+            if req._tunnel_host:
+                conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            return conn
+
+        key = (http_class, host, req._tunnel_host)
+        while True:
+            conn, reused = self.pool.acquire(key, connect)
+            try:
+                try:
+                    if conn.sock is None:
+                        conn.connect()
+                    conn.sock.settimeout(timeout.read)
+                    conn.request(
+                        req.get_method(),
+                        req.selector,
+                        req.data,
+                        headers,
+                        encode_chunked=req.has_header("Transfer-encoding"),
+                    )
+                except OSError as err:
+                    if reused and isinstance(err, ConnectionError):
+                        raise
+                    raise URLError(err)
+                response = conn.getresponse()
+            except ConnectionError as e:
+                conn.close()
+                if reused:
+                    log.debug("Pooled connection was dropped (%s), reconnecting", e)
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            break
+
+        response._release = functools.partial(self.pool.release, key, conn)
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+
+class RetryPolicy:
+    """Decides whether and when a failed request is retried.
+
+    The delay before the first retry is `delay` seconds and it is multiplied
+    by `multiplier` for each subsequent retry, capped at `max_delay`. A random
+    jitter of up to `jitter` times the delay is added or subtracted to avoid
+    that many clients retry in lockstep.
+
+    Parameters
+    ==========
+    retries: int
+      The maximum number of retries (the first attempt is not counted).
+    delay: float
+      The delay in seconds before the first retry.
+    multiplier: float
+      The factor the delay is multiplied with after each retry.
+    max_delay: float
+      The maximum delay in seconds between two attempts.
+    jitter: float
+      The relative jitter of the delay, e.g. 0.1 for +-10%.
+    deadline: float or None
+      The maximum time in seconds spent on a single call, including all
+      attempts and delays. No more retries are scheduled beyond that.
+    rules: dict(type: int) or None
+      The maximum number of retries per exception class, which overrides
+      `retries` for that class (and its subclasses). Use 0 to give up
+      immediately.
+    """
+
+    def __init__(
+        self,
+        retries=10,
+        delay=1,
+        multiplier=2,
+        max_delay=30,
+        jitter=0.1,
+        deadline=None,
+        rules=None,
+    ):
+        self.retries = retries
+        self.delay = delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.rules = {} if rules is None else dict(rules)
+
+    @classmethod
+    def fail_fast(cls):
+        """A policy for interactive use: a few quick retries within 10s"""
+        return cls(retries=2, delay=0.5, max_delay=2, deadline=10)
+
+    @classmethod
+    def patient(cls):
+        """A policy for batch jobs: keeps trying for up to an hour"""
+        return cls(retries=30, delay=5, max_delay=300, deadline=3600)
+
+    def __repr__(self):
+        return (
+            "{}(retries={}, delay={}, multiplier={}, max_delay={}, jitter={}, "
+            "deadline={}, rules={})".format(
+                self.__class__.__name__,
+                self.retries,
+                self.delay,
+                self.multiplier,
+                self.max_delay,
+                self.jitter,
+                self.deadline,
+                self.rules,
+            )
+        )
+
+    def replace(self, **kwargs):
+        """Return a copy of the policy with the given attributes replaced"""
+        policy = copy.copy(self)
+        for key, value in kwargs.items():
+            if not hasattr(policy, key):
+                raise AttributeError("Unknown retry policy parameter '{}'".format(key))
+            setattr(policy, key, value)
+        return policy
+
+    def max_retries(self, exception):
+        """The maximum number of retries for a given exception"""
+        for cls in type(exception).__mro__:
+            if cls in self.rules:
+                return self.rules[cls]
+        return self.retries
+
+    def backoff(self, exception, attempt, elapsed):
+        """Return the delay before the next attempt or None to give up
+
+        Parameters
+        ==========
+        exception: Exception
+          The exception which caused the last attempt to fail.
+        attempt: int
+          The number of retries so far.
+        elapsed: float
+          The time in seconds since the first attempt.
+        """
+        if attempt >= self.max_retries(exception):
+            return None
+        delay = min(self.delay * self.multiplier**attempt, self.max_delay)
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        return delay
+
+
 class DBManager:
     """
     Handles login and session management to the KM3NeT DB.
+
+    Parameters
+    ==========
+    url: str (optional)
+      The URL of the database web API
+    network_class: str or None (optional)
+      The network class ("B" or "C") when requesting a new session cookie.
+    pool_size: int (optional)
+      The maximum number of idle keep-alive connections kept per host.
+    idle_timeout: float (optional)
+      Idle keep-alive connections are closed after this many seconds.
+    retry_policy: RetryPolicy or None (optional)
+      Decides whether and when failed requests are retried.
+    connect_timeout: float or None (optional)
+      The timeout in seconds for establishing a connection.
+    read_timeout: float or None (optional)
+      The timeout in seconds for each read from an established connection.
+    cache: km3db.cache.ResponseCache, bool or None (optional)
+      An opt-in persistent cache for the responses. Pass `True` to use a
+      `ResponseCache` with the default settings.
+    coalesce: bool (optional)
+      Concurrent requests for the same URL (with the query parameters in any
+      order) wait for a single request and share its response.
     """
 
-    def __init__(self, url=None, network_class=None):
+    def __init__(
+        self,
+        url=None,
+        network_class=None,
+        pool_size=4,
+        idle_timeout=60,
+        retry_policy=None,
+        connect_timeout=30,
+        read_timeout=600,
+        cache=None,
+        coalesce=True,
+    ):
         self._db_url = BASE_URL if url is None else url
         self._login_url = self._db_url + "/home.htm"
         self._network_class = network_class
         self._session_cookie = None
         self._opener = None
         self._username = None
+        self._pool = ConnectionPool(maxsize=pool_size, idle_timeout=idle_timeout)
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.timeout = Timeout(connect_timeout, read_timeout)
+        if cache is True:
+            cache = km3db.cache.ResponseCache()
+        elif cache is False:
+            cache = None
+        self.cache = cache
+        self.coalesce = coalesce
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(
+        self,
+        url,
+        default=None,
+        retries=None,
+        binary=False,
+        retry_policy=None,
+        timeout=None,
+        deadline=None,
+    ):
+        """Get HTML content
+
+        Parameters
+        ==========
+        url: str
+          The URL, starting from the database website's root.
+        default: any (optional)
+          The value to return if the request fails.
+        retries: int or None (optional)
+          Overrides the maximum number of retries of the retry policy.
+        binary: bool (optional)
+          Return the raw bytes instead of a decoded string.
+        retry_policy: RetryPolicy or None (optional)
+          Overrides the retry policy of this `DBManager` for this call.
+        timeout: float, (float, float) or None (optional)
+          Overrides the (connect, read) timeouts of this `DBManager`.
+        deadline: float or None (optional)
+          An absolute point in time (as returned by `time.time()`) after
+          which the request is abandoned and `default` is returned.
+        """
+        key = canonical_url(url)
+        content = None
+        if self.cache is not None:
+            content = self.cache.lookup(key, binary=binary, base_url=self._db_url)
+            if content is not None:
+                log.debug("Cache hit for %s", key)
+        if content is None:
+            fetch = self._fetch_coalesced if self.coalesce else self._fetch
+            content = fetch(
+                url,
+                retries=retries,
+                retry_policy=retry_policy,
+                timeout=timeout,
+                deadline=deadline,
+            )
+            if content is None:
+                return default
+            if self.cache is not None:
+                self.cache.store(key, content, binary=binary, base_url=self._db_url)
 
-    def get(self, url, default=None, retries=10, binary=False):
-        "Get HTML content"
-        target_url = self._db_url + "/" + unquote(url)
-        log.debug("Accessing %s", target_url)
+        if binary:
+            return content
+        else:
+            return content.decode("utf-8")
+
+    def _fetch_coalesced(self, url, deadline=None, **kwargs):
+        """Like `_fetch` but concurrent calls for the same URL share one request
+
+        The callers waiting for an in-flight request get its result, the
+        retry and timeout settings of the first caller apply.
+        """
+        key = canonical_url(url)
+        if self._pid != os.getpid():
+            # requests in flight in the parent process will never finish here
+            self._inflight = {}
+            self._inflight_lock = threading.Lock()
+            self._pid = os.getpid()
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._inflight[key] = _InFlightRequest()
+        if not is_leader:
+            log.debug("Waiting for the in-flight request of %s", key)
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            if not call.done.wait(timeout):
+                log.error("Deadline exceeded, giving up.\nTarget URL: %s", key)
+                return None
+            return call.result
         try:
-            f = self.opener.open(target_url)
-        except HTTPError as e:
-            if e.code in (401, 403):
-                if retries:
+            call.result = self._fetch(url, deadline=deadline, **kwargs)
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            call.done.set()
+        return call.result
+
+    def open(self, url, retries=None, retry_policy=None, timeout=None, deadline=None):
+        """Open a URL and return the response as a binary file-like object
+
+        Establishing the connection is retried according to the retry policy,
+        the body however is left to the caller, so that it can be processed
+        while it is being transferred. The response is neither cached nor
+        shared with concurrent calls and should be closed after use.
+
+        Returns None if the request fails. See `get` for the parameters.
+        """
+        return self._fetch(
+            url,
+            retries=retries,
+            retry_policy=retry_policy,
+            timeout=timeout,
+            deadline=deadline,
+            stream=True,
+        )
+
+    def _fetch(
+        self,
+        url,
+        retries=None,
+        retry_policy=None,
+        timeout=None,
+        deadline=None,
+        stream=False,
+    ):
+        """Retrieve the raw content of a given URL
+
+        Returns the content or None on failure. Incompletely transferred
+        responses are retried according to the retry policy. If `stream` is
+        True, the unread response is returned instead of the content.
+        """
+        policy = self.retry_policy if retry_policy is None else retry_policy
+        if retries is not None:
+            policy = policy.replace(retries=retries)
+        timeout = self.timeout if timeout is None else Timeout.parse(timeout)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if policy.deadline is None or remaining < policy.deadline:
+                policy = policy.replace(deadline=remaining)
+        target_url = self._db_url + "/" + unquote(url)
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if policy.deadline is not None:
+                remaining = policy.deadline - (time.monotonic() - start)
+                if remaining <= 0:
                     log.error(
-                        "Access forbidden (error %d), your session has expired. "
-                        "Deleting the cookie (%s) and retrying once.",
-                        e.code,
-                        COOKIE_FILENAME,
+                        "Deadline exceeded, giving up.\nTarget URL: %s", target_url
                     )
-                    retries -= 1
-                else:
+                    return None
+                _timeout = timeout.clip(remaining)
+            else:
+                _timeout = timeout
+            log.debug("Accessing %s", target_url)
+            try:
+                f = self.opener.open(target_url, timeout=_timeout)
+                content = f if stream else f.read()
+            except HTTPError as e:
+                if e.code not in (401, 403):
+                    log.error("HTTP error: %s\n" "Target URL: %s", e, target_url)
+                    return None
+                delay = policy.backoff(e, attempt, time.monotonic() - start)
+                if delay is None:
                     log.critical("Access forbidden. Giving up...")
-                    return default
-                time.sleep(1)
+                    return None
+                log.error(
+                    "Access forbidden (error %d), your session has expired. "
+                    "Deleting the cookie (%s) and retrying.",
+                    e.code,
+                    COOKIE_FILENAME,
+                )
                 self.reset()
                 if os.path.exists(COOKIE_FILENAME):
                     os.remove(COOKIE_FILENAME)
-                return self.get(url, default=default, retries=retries)
-            log.error("HTTP error: %s\n" "Target URL: %s", e, target_url)
-            return default
-        except URLError as e:
-            if retries:
-                retries -= 1
-                log.error("URLError '%s', retrying in 30 seconds.", e)
-                time.sleep(30)
-                return self.get(url, default=default, retries=retries)
-            else:
-                log.error("Giving up... URLError: %s\n" "Target URL: %s", e, target_url)
-                return default
-        except RemoteDisconnected as e:
-            if retries:
-                retries -= 1
-                log.error("RemoteDisconnected '%s', retrying in 30 seconds.", e)
-                time.sleep(30)
-                return self.get(url, default=default, retries=retries)
-            else:
+            except (URLError, RemoteDisconnected, IncompleteRead, socket.timeout) as e:
+                delay = policy.backoff(e, attempt, time.monotonic() - start)
+                if delay is None:
+                    log.error(
+                        "Giving up... %s: %s\n" "Target URL: %s",
+                        type(e).__name__,
+                        e,
+                        target_url,
+                    )
+                    return None
                 log.error(
-                    "Giving up... RemoteDisconnected: %s\n" "Target URL: %s",
-                    e,
-                    target_url,
+                    "%s '%s', retrying in %.1f seconds.", type(e).__name__, e, delay
                 )
-                return default
-        try:
-            content = f.read()
-        except IncompleteRead as icread:
-            log.error("Incomplete data received from the DB.")
-            content = icread.partial
-        log.debug("Got {0} bytes of data.".format(len(content)))
+            else:
+                break
+            attempt += 1
+            time.sleep(delay)
 
-        if binary:
-            return content
-        else:
-            return content.decode("utf-8")
+        if not stream:
+            log.debug("Got {0} bytes of data.".format(len(content)))
+        return content
 
     def reset(self):
         "Reset everything"
         self._opener = None
         self._session_cookie = None
 
+    def close(self):
+        "Close all pooled connections"
+        self._pool.clear()
+
+    def grow_pool(self, pool_size):
+        "Keep at least `pool_size` idle connections per host"
+        self._pool.maxsize = max(self._pool.maxsize, pool_size)
+
+    @property
+    def url(self):
+        "The URL of the database web API"
+        return self._db_url
+
     @property
     def session_cookie(self):
         if self._session_cookie is None:
@@ -222,7 +721,7 @@ class DBManager:
         "A reusable connection manager"
         if self._opener is None:
             log.debug("Creating connection handler")
-            opener = urllib.request.build_opener()
+            opener = urllib.request.build_opener(KeepAliveHandler(self._pool))
             cookie = self.session_cookie
             if cookie is None:
                 log.critical("Could not connect to database.")
@@ -241,6 +740,60 @@ class DBManager:
         return self._username
 
 
+_db_managers = {}
+_db_managers_lock = threading.Lock()
+
+
+def get_db_manager(url=None, network_class=None, pool_size=None):
+    """Return the shared `DBManager` for a given URL and network class
+
+    The instances are created on first use and reused by `StreamDS`, `APIv2`,
+    `JSONDS` and the helper functions, so that a process resolves the session
+    cookie and sets up the connections only once. The registry is emptied in
+    child processes after a fork. If `pool_size` is given, the connection
+    pool of the instance keeps at least that many idle connections per host.
+    """
+    # the class is part of the key, so that a patched/mocked DBManager
+    # does not leak into the registry of the real one
+    key = (DBManager, BASE_URL if url is None else url, network_class)
+    with _db_managers_lock:
+        db = _db_managers.get(key)
+        if db is None:
+            db = _db_managers[key] = DBManager(url=url, network_class=network_class)
+        if pool_size is not None:
+            db.grow_pool(pool_size)
+    return db
+
+
+def _reset_db_managers():
+    global _db_managers_lock
+    _db_managers.clear()
+    _db_managers_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_db_managers)
+
+
+class _InFlightRequest:
+    """The shared result of a request which is in progress"""
+
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def canonical_url(url):
+    """Return the unquoted URL with its query parameters sorted"""
+    path, _, query = unquote(url).partition("?")
+    parameters = sorted(p for p in query.split("&") if p)
+    if not parameters:
+        return path
+    return path + "?" + "&".join(parameters)
+
+
 def on_whitelisted_host(name):
     """Check if we are on a whitelisted host"""
     if name == "gitlab":
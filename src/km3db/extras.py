@@ -29,3 +29,19 @@ def h5py():
         )
     else:
         return h5py
+
+
+def pyarrow():
+    """Imports and returns ``pyarrow`` (with ``pyarrow.csv``)."""
+    try:
+        import pyarrow
+        import pyarrow.csv
+    except ImportError:
+        raise ImportError(
+            "install the 'pyarrow' package with:\n\n"
+            "    pip install pyarrow\n\n"
+            "or\n\n"
+            "    conda install pyarrow"
+        )
+    else:
+        return pyarrow
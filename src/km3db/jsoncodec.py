@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Filename: jsoncodec.py
+"""
+JSON encoding and decoding for the database clients.
+
+The fast ``orjson`` backend is used if it is installed, the ``json`` module
+of the standard library otherwise. The backend can be switched with `use()`.
+JSON is decoded directly from the raw response bytes and encoded to bytes,
+so no intermediate ``str`` copies are needed.
+
+Both backends write compact UTF-8 encoded JSON. Notice that ``orjson``
+encodes NaN and infinite floats as ``null`` while the ``json`` module writes
+them as ``NaN`` and ``Infinity``, so they should be replaced before encoding.
+
+"""
+
+from functools import partial
+import json
+
+from km3db.logger import log
+
+JSONDecodeError = json.JSONDecodeError
+
+backend = None
+_loads = None
+_dumps = None
+
+
+def loads(data):
+    """Decode JSON from bytes or str"""
+    return _loads(data)
+
+
+def dumps(obj):
+    """Encode an object as UTF-8 encoded JSON (bytes)"""
+    return _dumps(obj)
+
+
+def use(name=None):
+    """Select the JSON backend ("orjson" or "json")
+
+    If `name` is None, ``orjson`` is used if it is installed.
+    """
+    global backend, _loads, _dumps
+    if name is None:
+        try:
+            use("orjson")
+        except ImportError:
+            use("json")
+        return
+    if name == "orjson":
+        import orjson
+
+        _loads = orjson.loads
+        _dumps = partial(orjson.dumps, option=orjson.OPT_SERIALIZE_NUMPY)
+    elif name == "json":
+        _loads = json.loads
+        _dumps = _json_dumps
+    else:
+        raise ValueError("Unknown JSON backend '{}'".format(name))
+    backend = name
+    log.debug("Using the '%s' JSON backend", name)
+
+
+def _json_dumps(obj):
+    # compact and without escaping, like orjson
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+use()
@@ -1,28 +1,80 @@
 #!/usr/bin/env python3
+from array import array
+import codecs
 from collections import OrderedDict, namedtuple
-from functools import wraps
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import total_ordering
+from http.client import IncompleteRead
 from inspect import Parameter, Signature
 import io
 import json
+import re
+from operator import itemgetter, methodcaller
+import string
+import time
 
 import numpy as np
 
+from km3db.cache import memoize
+import km3db.cache
 import km3db.core
 import km3db.extras
+import km3db.jsoncodec
 from km3db.logger import log
 
+BatchResult = namedtuple("BatchResult", "selectors data error")
+
 
 class APIv2:
+    """Access to the APIv2 endpoints of the KM3NeT database
+
+    The endpoints are available as functions, e.g.
+    ``api.RunCalibration(DetOId="D_ORCA006", Run=1234)``.
+
+    The catalog of the endpoints is only retrieved when needed and cached on
+    disk for `catalog_ttl` seconds. The endpoint functions are created once
+    per instance.
+
+    Parameters
+    ==========
+    url: str (optional)
+      The URL of the database web API, by default the one of `db`
+    container: str or None (optional)
+      The default container type of the results, which can also be passed
+      to the endpoint functions (``container=...``).
+        None (default): a list of dicts, as returned from the DB
+          "np": `numpy` structured array, see `tocolumns`
+          "pd": `pandas.DataFrame`
+      The types of the columns are taken from the ``Schema`` of the endpoint.
+    max_workers: int (optional)
+      The maximum number of concurrent requests of `batch`.
+    db: km3db.core.DBManager or None (optional)
+      The `DBManager` which carries out the requests, e.g. one with a
+      response cache or a custom retry policy. By default, the shared
+      instance for `url` is used (see `km3db.core.get_db_manager`).
+    """
+
     _api_endpoint = "apiv2.1.0/"
     _valid_operators = ("<", "<=", ">", ">=", "<>", "!=")
-
-    def __init__(self, url=None, container=None):
-        self._db = km3db.core.DBManager(url=url)
+    catalog_ttl = 24 * 60 * 60
+
+    def __init__(self, url=None, container=None, max_workers=4, db=None):
+        if db is None:
+            db = km3db.core.get_db_manager(url=url)
+        elif url is None:
+            url = db.url
+        self._db = db
+        self._db_url = km3db.core.BASE_URL if url is None else url
+        self._default_container = container
+        self.max_workers = max_workers
         self._endpoints = None
-        self._update_endpoints()
+        self._schemas = {}
 
-    def __getattr__(self, attr, **kwargs):
+    def __getattr__(self, attr):
         """Magic getter to select a specific stream"""
+        if attr.startswith("_"):
+            raise AttributeError(attr)
         if attr not in self.endpoints:
             raise AttributeError(
                 "Invalid selector: '{}'. Please use one of these: {}".format(
@@ -30,22 +82,12 @@ class APIv2:
                 )
             )
 
-        def func(**kwargs):
-            url = "{}/s?".format(attr)
-            for key, value in kwargs.items():
-                key = str(key)
-                value = str(value)
-                url += "&" + key
-                if any(value.startswith(op) for op in self._valid_operators):
-                    url += value
-                else:
-                    url += "=" + value
-            return self._get(url)
+        def func(deadline=None, container=None, **kwargs):
+            data = self._get(self._url(attr, kwargs), deadline=deadline)
+            return self._convert(attr, data, container)
 
         func.__doc__ = self.endpoints[attr]["Description"]
 
-        # TODO: schema not used yet
-        # schema = _extract_schema(self.endpoints[attr]["Schema"])
         selectors = _extract_selectors(self.endpoints[attr]["Selectors"])
 
         func.__doc__ += "\n\nParameters:\n"
@@ -53,44 +95,210 @@ class APIv2:
         for sel, description in selectors.items():
             func.__doc__ += "    {}: {}\n".format(sel, description)
             sig_dict[Parameter(sel, Parameter.KEYWORD_ONLY)] = None
+        sig_dict[Parameter("container", Parameter.KEYWORD_ONLY, default=None)] = None
 
         func.__signature__ = Signature(parameters=sig_dict)
 
+        setattr(self, attr, func)
         return func
 
+    def iter(
+        self, endpoint, batch_size=None, chunk_size=2**16, deadline=None, **kwargs
+    ):
+        """Iterate over the results of an endpoint while they are retrieved
+
+        The response is parsed incrementally, so the memory usage does not
+        depend on the size of the result. The entries of ``Data`` are yielded
+        one by one or in lists of up to `batch_size` entries. Errors reported
+        by the database are logged and end the iteration.
+
+        Parameters
+        ==========
+        endpoint: str
+          Name of the endpoint (e.g. RunCalibration)
+        batch_size: int or None
+          If given, lists of up to `batch_size` entries are yielded.
+        chunk_size: int
+          The maximum number of bytes read at once.
+        deadline: float or None
+          An absolute point in time (as returned by `time.time()`) after
+          which establishing the connection is abandoned.
+        """
+        if endpoint not in self._catalog(deadline):
+            log.error("There is no endpoint called '%s'", endpoint)
+            return
+        url = self._api_endpoint + self._url(endpoint, kwargs)
+        response = self._db.open(url, deadline=deadline)
+        if response is None:
+            log.error("No data found at URL '%s'." % url)
+            return
+
+        def check(envelope, final):
+            if "Error" in envelope or final:
+                return self._validate(envelope)
+            return True
+
+        with response:
+            entries = _iter_json_data(response, check, chunk_size=chunk_size)
+            yield from entries if batch_size is None else _batched(entries, batch_size)
+
+    def batch(self, endpoint, selectors, container=None, deadline=None):
+        """Call an endpoint concurrently for a list of selectors
+
+        The requests are carried out by up to `max_workers` threads, which
+        share the connection pool of the `DBManager`.
+
+        Parameters
+        ==========
+        endpoint: str
+          Name of the endpoint (e.g. RunCalibration)
+        selectors: list(dict)
+          The selectors of each call, e.g. ``[dict(DetOId=..., Run=run)]``.
+        container: str or None
+          The container of the results, see `APIv2`.
+        deadline: float or None
+          An absolute point in time (as returned by `time.time()`) after
+          which the remaining requests are abandoned.
+
+        Returns
+        =======
+        A list of `BatchResult` (selectors, data, error) in the order of
+        `selectors`. For failed calls, `data` is None and `error` holds the
+        exception, e.g. a `ValueError` with the error reported by the DB.
+        """
+        endpoints = self._catalog(deadline)
+        if endpoint not in endpoints:
+            raise AttributeError(
+                "Invalid selector: '{}'. Please use one of these: {}".format(
+                    endpoint, ", ".join(endpoints.keys())
+                )
+            )
+        selectors = list(selectors)
+
+        def call(kwargs):
+            try:
+                data = self._request(self._url(endpoint, kwargs), deadline=deadline)
+                data = self._convert(endpoint, data, container)
+            except Exception as e:
+                log.debug("%s(%s) failed: %s", endpoint, kwargs, e)
+                return BatchResult(kwargs, None, e)
+            return BatchResult(kwargs, data, None)
+
+        workers = max(1, min(self.max_workers, len(selectors)))
+        self._db.grow_pool(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(call, selectors))
+        n_failed = sum(result.error is not None for result in results)
+        if n_failed:
+            log.warning(
+                "%d of the %d calls of '%s' failed", n_failed, len(results), endpoint
+            )
+        return results
+
+    def _convert(self, endpoint, data, container=None):
+        """Convert the data of an endpoint to the given container type"""
+        if container is None:
+            container = self._default_container
+        if container is None or not isinstance(data, list):
+            return data
+        schema = self._schemas.get(endpoint)
+        if schema is None:
+            schema = _extract_schema(self.endpoints[endpoint].get("Schema") or [])
+            self._schemas[endpoint] = schema
+        if container == "np":
+            return tonumpy_columns(tocolumns(data, schema))
+        if container == "pd":
+            return km3db.extras.pandas().DataFrame(tocolumns(data, schema))
+        raise ValueError("Unknown container type '{}'".format(container))
+
+    def _url(self, endpoint, selectors):
+        """The URL (relative to the API) for a given endpoint and selectors"""
+        url = "{}/s?".format(endpoint)
+        for key, value in selectors.items():
+            key = str(key)
+            value = str(value)
+            url += "&" + key
+            if any(value.startswith(op) for op in self._valid_operators):
+                url += value
+            else:
+                url += "=" + value
+        return url
+
     @property
     def endpoints(self):
-        return {e["Name"]: e for e in self._endpoints}
+        return self._catalog()
 
-    def _update_endpoints(self):
-        """Update the list of available endpoints"""
-        self._endpoints = self._get()
+    def _catalog(self, deadline=None):
+        """The endpoint catalog, which is retrieved within `deadline` if needed"""
+        if self._endpoints is None:
+            return self._update_endpoints(deadline=deadline)
+        return self._endpoints
 
-    def _get(self, url="", default=None, **kwargs):
+    def _update_endpoints(self, refresh=False, deadline=None):
+        """Update the list of available endpoints and return it
+
+        The catalog is taken from the on-disk cache unless `refresh` is True.
+        If it cannot be retrieved, an empty catalog is returned and the
+        retrieval is retried on the next access.
+        """
+        cache = km3db.cache.CatalogCache()
+        key = "apiv2:" + self._db_url
+        endpoints = None if refresh else cache.get(key)
+        if endpoints is None:
+            endpoints = self._get(deadline=deadline)
+            if endpoints is None:
+                log.error("Could not retrieve the APIv2 endpoints")
+                return OrderedDict()
+            cache.set(key, endpoints, ttl=self.catalog_ttl)
+        self._endpoints = OrderedDict((e["Name"], e) for e in endpoints)
+        return self._endpoints
+
+    def _get(self, url="", default=None, deadline=None, **kwargs):
         """Return the data for a given APIv2 endpoint. Does not raise."""
         try:
-            final_url = "{}{}".format(self._api_endpoint, url)
-            response = json.loads(self._db.get(final_url))
-        except json.JSONDecodeError:
-            log.error("Invalid JSON data received from the DB")
-            return default
-        if not self._validate(response):
+            return self._request(url, deadline=deadline)
+        except ValueError as e:
+            log.error(e)
             return default
+
+    def _request(self, url="", deadline=None):
+        """Return the data for a given APIv2 endpoint
+
+        Raises a `ValueError` if there is no (valid) response or the DB
+        reports an error.
+        """
+        final_url = "{}{}".format(self._api_endpoint, url)
+        content = self._db.get(final_url, binary=True, deadline=deadline)
+        if content is None:
+            raise ValueError("No data found at URL '{}'.".format(final_url))
+        try:
+            response = km3db.jsoncodec.loads(content)
+        except km3db.jsoncodec.JSONDecodeError:
+            raise ValueError("Invalid JSON data received from the DB")
+        error = _error_message(response)
+        if error is not None:
+            raise ValueError(error)
         return response["Data"]
 
     def _validate(self, response):
         """Returns True if the DB response is OK, False otherwise."""
-        err = response["Error"]
-        if err["Code"] != "OK":
-            log.error(
-                "Error from the DB ({}): {} (arguments: {})".format(
-                    err["Code"], err["Message"], err["Arguments"]
-                )
-            )
+        error = _error_message(response)
+        if error is not None:
+            log.error(error)
             return False
         return True
 
 
+def _error_message(response):
+    """The error message of an APIv2 response or None if it is OK"""
+    err = response["Error"]
+    if err["Code"] == "OK":
+        return None
+    return "Error from the DB ({}): {} (arguments: {})".format(
+        err["Code"], err["Message"], err["Arguments"]
+    )
+
+
 def _extract_selectors(raw_strings):
     """Creates a dictionary from the raw DB output (list of strings).
 
@@ -106,44 +314,242 @@ def _extract_selectors(raw_strings):
     return selectors
 
 
+def _extract_schema(raw_entries):
+    """Creates a dictionary of field names and types from the raw DB output
+
+    The entries are either strings like "Run -> Integer" (like the selectors)
+    or dicts with "Name" and "Type". The type is None if it is not given.
+    """
+    schema = OrderedDict()
+    for entry in raw_entries:
+        if isinstance(entry, dict):
+            name, type_name = entry.get("Name"), entry.get("Type")
+        else:
+            name, _, type_name = str(entry).partition(" -> ")
+        if name:
+            schema[name.strip()] = type_name.strip() if type_name else None
+    return schema
+
+
+def tocolumns(data, schema=None):
+    """Convert a list of dicts (APIv2 results) to typed numpy columns
+
+    Returns an `OrderedDict` of field names and numpy arrays. The fields and
+    their types are taken from the `schema` (a dict of field names and type
+    names like "Integer", "Double" or "String", see `_extract_schema`),
+    fields which are not in the schema are added in the order of the first
+    entry and their types are inferred. Each column is built in one pass
+    over the entries. Missing integers are turned into NaN (float64), missing
+    strings into empty strings.
+    """
+    fields = OrderedDict(schema or {})
+    if data:
+        for name in data[0]:
+            fields.setdefault(name, None)
+    columns = OrderedDict()
+    for name, type_name in fields.items():
+        values = list(map(methodcaller("get", name), data))
+        columns[name] = _json_column(values, _schema_kind(type_name))
+    return columns
+
+
+def tonumpy_columns(columns):
+    """Create a structured array from a dict of numpy arrays"""
+    length = len(next(iter(columns.values()))) if columns else 0
+    arr = np.empty(length, dtype=[(n, c.dtype) for n, c in columns.items()])
+    for name, column in columns.items():
+        arr[name] = column
+    return arr
+
+
+def _schema_kind(type_name):
+    """The numpy kind ("b", "i", "f" or "U") of an APIv2 schema type or None"""
+    if type_name is None:
+        return None
+    name = type_name.lower()
+    if "bool" in name:
+        return "b"
+    if "int" in name or "long" in name:
+        return "i"
+    if any(t in name for t in ("float", "double", "real", "decimal", "num")):
+        return "f"
+    if any(t in name for t in ("char", "str", "text", "date", "time")):
+        return "U"
+    return None
+
+
+def _json_column(values, kind=None):
+    """Convert a list of decoded JSON values to a numpy array
+
+    If `kind` is None, the type is inferred from the first value which is not
+    None (bool, int64, float64 or str, nested objects are kept as they are).
+    """
+    n = len(values)
+    if kind is None:
+        first = next((v for v in values if v is not None), None)
+        if isinstance(first, (dict, list)):
+            arr = np.empty(n, dtype=object)
+            arr[:] = values
+            return arr
+        kind = _json_kinds.get(type(first), "f" if first is None else "U")
+    if not n:
+        return np.array([], dtype=_empty_json_dtypes.get(kind, np.float64))
+    if kind == "b":
+        if None not in values:
+            return np.fromiter(values, bool, n)
+        return np.array(values, dtype=object).reshape(n)
+    if kind == "i":
+        try:
+            arr = np.array(values)
+        except (TypeError, ValueError, OverflowError):
+            pass
+        else:
+            if arr.dtype.kind in "iu" and arr.ndim == 1:
+                return arr.astype(np.int64)
+    if kind in ("i", "f"):
+        try:
+            return np.array(values, dtype=np.float64).reshape(n)
+        except (TypeError, ValueError):
+            pass
+    arr = np.array(values, dtype=object).reshape(n)
+    arr[np.equal(arr, None)] = ""
+    return arr.astype("U")
+
+
+_json_kinds = {bool: "b", int: "i", float: "f", str: "U"}
+_empty_json_dtypes = {"b": bool, "i": np.int64, "f": np.float64, "U": "U1"}
+
+
 class StreamDS:
     """Access to the streamds data stored in the KM3NeT database.
 
     Parameters
     ==========
     url: str (optional)
-      The URL of the database web API
+      The URL of the database web API, by default the one of `db`
     container: str or None (optional)
       The default containertype when returning data.
         None (default): the data, as returned from the DB
           "nt": `namedtuple`, can be used when no pandas is available
+          "records": compact `Records` with namedtuple-like rows
           "pd": `pandas.DataFrame`, as returned in KM3Pipe v8 and below
+          "np": `numpy` structured array with typed columns, see `tonumpy`
+          "arrow": `pyarrow.Table`, see `toarrow`
+    runs_per_request: int or None (optional)
+      Queries with a `minrun`/`maxrun` range spanning more runs are split
+      into several requests, None disables the splitting.
+    seconds_per_request: int or None (optional)
+      The same for `unixmintime`/`unixmaxtime` ranges.
+    max_workers: int (optional)
+      The maximum number of concurrent requests of a split query or of
+      multi-valued selectors.
+    result_cache: km3db.cache.ResultCache, bool or None (optional)
+      An opt-in persistent cache of the results, which is used for all
+      container types except the raw output. Pass `True` to use a
+      `ResultCache` with the default settings.
+    runs_mirror: RunsMirror, bool or None (optional)
+      An opt-in local mirror of the `runs` stream, which answers queries of
+      the `runs` stream by `detid` (and optionally `run`) for all container
+      types except the raw output. Pass `True` to use a `RunsMirror` with the
+      default settings.
+    schema_cache: km3db.cache.SchemaCache or bool (optional)
+      The storage of the learned column types of the streams, which are used
+      to parse the data for the "pd" container (see `pandas_schema`). Pass
+      `False` to let pandas infer the types on each call.
+    db: km3db.core.DBManager or None (optional)
+      The `DBManager` which carries out the requests, e.g. one with a
+      response cache or a custom retry policy. By default, the shared
+      instance for `url` is used (see `km3db.core.get_db_manager`).
+
+    The catalog of the available streams is only retrieved when needed, e.g.
+    on the first access to `streams` or to a stream function like
+    `sds.runs()`. It is cached on disk for `catalog_ttl` seconds.
+
+    Selectors can be given as a list, tuple or range of values, e.g.
+    ``sds.clbmap(detoid=["D_ORCA006", "D_ARCA021"])``. One request per value
+    (or combination of values) is carried out concurrently and the results
+    are merged, tagged by a leading column named after the selector (e.g.
+    ``DETOID``) unless the stream already contains such a column.
     """
 
-    def __init__(self, url=None, container=None):
-        self._db = km3db.core.DBManager(url=url)
+    catalog_ttl = 24 * 60 * 60
+
+    def __init__(
+        self,
+        url=None,
+        container=None,
+        runs_per_request=1000,
+        seconds_per_request=7 * 24 * 60 * 60,
+        max_workers=4,
+        result_cache=None,
+        runs_mirror=None,
+        schema_cache=True,
+        db=None,
+    ):
+        if db is None:
+            db = km3db.core.get_db_manager(url=url)
+        elif url is None:
+            url = db.url
+        self._db = db
+        self._db_url = km3db.core.BASE_URL if url is None else url
         self._streams = None
-        self._update_streams()
         self._default_container = container
+        self.runs_per_request = runs_per_request
+        self.seconds_per_request = seconds_per_request
+        self.max_workers = max_workers
+        if result_cache is True:
+            result_cache = km3db.cache.ResultCache()
+        elif result_cache is False:
+            result_cache = None
+        self.result_cache = result_cache
+        if runs_mirror is True:
+            runs_mirror = RunsMirror(self)
+        elif runs_mirror is False:
+            runs_mirror = None
+        self.runs_mirror = runs_mirror
+        if schema_cache is True:
+            schema_cache = km3db.cache.SchemaCache()
+        elif schema_cache is False:
+            schema_cache = None
+        self.schema_cache = schema_cache
+        self._schemas = {}
 
     @property
     def streams(self):
+        if self._streams is None:
+            return self._update_streams()
         return self._streams
 
-    def _update_streams(self):
-        """Update the list of available straems"""
-        content = self._db.get("streamds")
-        self._streams = OrderedDict()
+    def _update_streams(self, refresh=False):
+        """Update the list of available streams and return it
+
+        The catalog is taken from the on-disk cache unless `refresh` is True.
+        If it cannot be retrieved, an empty catalog is returned and the
+        retrieval is retried on the next access.
+        """
+        cache = km3db.cache.CatalogCache()
+        key = "streamds:" + self._db_url
+        content = None if refresh else cache.get(key)
+        if content is None:
+            content = self._db.get("streamds")
+            if not content or content.startswith("ERROR"):
+                log.error("Could not retrieve the list of streams")
+                return OrderedDict()
+            cache.set(key, content, ttl=self.catalog_ttl)
+        streams = OrderedDict()
         for entry in tonamedtuples("Stream", content):
-            self._streams[entry.stream] = entry
-            setattr(self, entry.stream, self.__getattr__(entry.stream))
+            streams[entry.stream] = entry
+        self._streams = streams
+        return streams
 
     def __getattr__(self, attr):
         """Magic getter which optionally populates the function signatures"""
+        if attr.startswith("_"):
+            raise AttributeError(attr)
         if attr in self.streams:
             stream = self.streams[attr]
         else:
-            raise AttributeError
+            raise AttributeError(attr)
 
         def func(**kwargs):
             return self.get(attr, **kwargs)
@@ -159,8 +565,10 @@ class StreamDS:
             if sel == "-":
                 continue
             sig_dict[Parameter(sel, Parameter.KEYWORD_ONLY)] = None
+        sig_dict[Parameter("columns", Parameter.KEYWORD_ONLY, default=None)] = None
         func.__signature__ = Signature(parameters=sig_dict)
 
+        setattr(self, attr, func)
         return func
 
     def print_streams(self):
@@ -190,7 +598,16 @@ class StreamDS:
                 )
             )
 
-    def get(self, stream, fmt="txt", container=None, renamemap=None, **kwargs):
+    def get(
+        self,
+        stream,
+        fmt="txt",
+        container=None,
+        renamemap=None,
+        deadline=None,
+        columns=None,
+        **kwargs,
+    ):
         """Retrieve the data for a given stream manually
 
         Parameters
@@ -202,26 +619,93 @@ class StreamDS:
         container: str or None
           The container to wrap the returned data, as specified in
           `StreamDS`.
+        deadline: float or None
+          An absolute point in time (as returned by `time.time()`) after
+          which the request is abandoned.
+        columns: list(str) or None
+          Only parse and return these columns (in the given order), either
+          by their name in the database output (e.g. "RUN") or their field
+          name (e.g. "run" or the one given in `renamemap`). The other
+          columns are skipped while parsing.
+
+        Large run or time ranges are retrieved in chunks, see `StreamDS`.
         """
-        sel = "".join(["&{0}={1}".format(k, v) for (k, v) in kwargs.items()])
-        url = "streamds/{0}.{1}?{2}".format(stream, fmt, sel[1:])
-        log.debug("URL: %s" % url)
-        data = self._db.get(url)
-        if not data:
-            log.error("No data found at URL '%s'." % url)
-            return
-        if data.startswith("ERROR"):
-            log.error(data)
-            return
-
         if container is None and self._default_container is not None:
             container = self._default_container
 
+        multi_valued = any(map(_is_multi_valued, kwargs.values()))
+
+        data = None
+        if (
+            stream == "runs"
+            and self.runs_mirror is not None
+            and container in _cached_containers
+            and fmt in ("txt", "text")
+            and set(kwargs) <= {"detid", "run"}
+            and "detid" in kwargs
+            and not multi_valued
+        ):
+            data = self.runs_mirror.get(
+                kwargs["detid"], run=kwargs.get("run"), deadline=deadline
+            )
+
+        url = self._url(stream, fmt, kwargs)
+        cache = None
+        if data is None and container in _cached_containers and fmt in ("txt", "text"):
+            cache = self.result_cache
+        if cache is not None:
+            key = km3db.core.canonical_url(self._db_url + "/" + url)
+            data = cache.get(key)
+            if data is not None:
+                log.debug("Result cache hit for %s", key)
+
+        if data is None:
+            partitions = []
+            if fmt in ("txt", "text"):
+                partitions = [
+                    (tags, chunk)
+                    for tags, selectors in _expand_selectors(kwargs)
+                    for chunk in self._partition(selectors)
+                ]
+            if len(partitions) > 1 or multi_valued:
+                data = self._get_partitioned(stream, fmt, partitions, deadline)
+            elif container == "arrow" and cache is None:
+                # the Arrow CSV reader parses the undecoded response
+                data = self._db.get(url, binary=True, deadline=deadline)
+            else:
+                data = self._db.get(url, deadline=deadline)
+            if not data:
+                log.error("No data found at URL '%s'." % url)
+                return
+            if isinstance(data, bytes) and data.startswith(b"ERROR"):
+                data = data.decode("utf-8", "replace")
+            if isinstance(data, str) and data.startswith("ERROR"):
+                log.error(data)
+                return
+            if cache is not None:
+                cache.set(key, data, ttl=self._result_ttl(cache, kwargs, deadline))
+        if fmt in ("txt", "text") and not _check_columns(
+            _split_header(data), columns, renamemap
+        ):
+            return
+
         try:
             if container == "pd":
-                return topandas(data)
-            if container == "nt":
-                return tonamedtuples(stream.capitalize(), data, renamemap=renamemap)
+                return self._topandas(stream, data, columns=columns)
+            if container in ("nt", "records"):
+                return tonamedtuples(
+                    stream.capitalize(),
+                    data,
+                    renamemap=renamemap,
+                    columns=columns,
+                    compact=container == "records",
+                )
+            if container == "np":
+                return tonumpy(data, renamemap=renamemap, columns=columns)
+            if container == "arrow":
+                return toarrow(data, columns=columns)
+            if columns is not None and fmt in ("txt", "text"):
+                return _project_text(data, columns)
         except ValueError:
             log.critical(
                 "Unable to convert data to container type '{}'. "
@@ -230,6 +714,361 @@ class StreamDS:
         else:
             return data
 
+    def iter(
+        self,
+        stream,
+        batch_size=None,
+        renamemap=None,
+        chunk_size=2**16,
+        deadline=None,
+        **kwargs,
+    ):
+        """Iterate over the rows of a given stream while they are retrieved
+
+        The response is read and parsed in chunks, so the memory usage does
+        not depend on the size of the result and the first rows are available
+        before the transfer has finished. An `http.client.IncompleteRead` is
+        raised if the connection is lost during the transfer.
+
+        Parameters
+        ==========
+        stream: str
+          Name of the stream (e.g. runs)
+        batch_size: int or None
+          If None, the rows are yielded one by one as namedtuples (like
+          `container="nt"`), otherwise as numpy structured arrays (like
+          `container="np"`) of up to `batch_size` rows. The types of the
+          columns are inferred for each batch separately.
+        renamemap: dict(str: str) or None (default)
+          Rename the fields according to this map.
+        chunk_size: int
+          The maximum number of bytes read at once.
+        deadline: float or None
+          An absolute point in time (as returned by `time.time()`) after
+          which establishing the connection is abandoned.
+        """
+        url = self._url(stream, "txt", kwargs)
+        response = self._db.open(url, deadline=deadline)
+        if response is None:
+            log.error("No data found at URL '%s'." % url)
+            return
+        with response:
+            lines = _iter_lines(response, chunk_size=chunk_size)
+            header = next(lines, None)
+            if header is None:
+                log.error("No data found at URL '%s'." % url)
+                return
+            if header.startswith("ERROR"):
+                log.error("\n".join([header, *lines]))
+                return
+            if batch_size is None:
+                if renamemap is None:
+                    renamemap = {}
+                cls = _namedtuple_class(
+                    stream.capitalize(),
+                    tuple(renamemap.get(s, s.lower()) for s in header.split()),
+                )
+                for line in lines:
+                    yield cls(*map(tonum, line.split("\t")))
+                return
+            batch = [header]
+            for line in lines:
+                batch.append(line)
+                if len(batch) > batch_size:
+                    yield tonumpy("\n".join(batch), renamemap=renamemap)
+                    batch = [header]
+            if len(batch) > 1:
+                yield tonumpy("\n".join(batch), renamemap=renamemap)
+
+    def _topandas(self, stream, data, columns=None):
+        """Create a DataFrame using the learned schema of the stream
+
+        The schema is learned on the first call (or when the header of the
+        stream has changed) and stored in the `schema_cache`. If the data
+        does not fit the schema anymore, the types are inferred again.
+        """
+        if self.schema_cache is None:
+            return topandas(data, columns=columns)
+        header = _split_header(data)
+        key = "schema:{}:{}".format(self._db_url, stream)
+        schema = self._schemas.get(key)
+        if schema is None:
+            schema = self.schema_cache.get(key)
+        if schema is not None and schema[0] == header:
+            self._schemas[key] = schema
+            try:
+                return topandas(data, columns=columns, dtype=schema[1])
+            except (ValueError, TypeError) as e:
+                log.debug("The schema of '%s' does not fit anymore: %s", stream, e)
+        df = topandas(data)
+        if len(df):
+            schema = (header, pandas_schema(df))
+            self._schemas[key] = schema
+            self.schema_cache.set(key, schema)
+            # parsing again gives the same values as the later calls, which
+            # would not be the case with astype (e.g. NaN becoming 'nan')
+            return topandas(data, columns=columns, dtype=schema[1])
+        if columns is not None:
+            df = df[[header[idx] for idx in _column_indices(header, columns)]]
+        return df
+
+    def _result_ttl(self, cache, selectors, deadline=None):
+        """The TTL of a cached result, None if the result cannot change anymore
+
+        This is the case if the requested runs are all before the last run of
+        the detector, which is taken from the `detectors` stream.
+        """
+        run = selectors.get("maxrun", selectors.get("run"))
+        det = selectors.get("detid", selectors.get("detoid"))
+        if run is None or det is None:
+            return cache.open_ttl
+        try:
+            run = int(run)
+        except (TypeError, ValueError):
+            return cache.open_ttl
+        last_run = self.last_run(det, deadline=deadline)
+        if last_run is not None and run < last_run:
+            return None
+        return cache.open_ttl
+
+    def last_run(self, det, cached=True, deadline=None):
+        """The last run of a detector (ID or OID) or None if it is unknown
+
+        The run is taken from the `detectors` stream, which is retrieved from
+        the database directly if `cached` is False. An optional `deadline`
+        (as returned by `time.time()`) can be specified.
+        """
+        if cached:
+            detectors = self.get("detectors", container="nt", deadline=deadline)
+            detectors = detectors or []
+        else:
+            url = self._url("detectors", "txt", {})
+            data = self._db.get(url, deadline=deadline)
+            if not data or data.startswith("ERROR"):
+                return None
+            detectors = tonamedtuples("Detectors", data)
+        for detector in detectors:
+            if str(det) in (str(detector.serialnumber), detector.oid):
+                if isinstance(detector.lastrun, int):
+                    return detector.lastrun
+                break
+        return None
+
+    def _partition(self, selectors):
+        """Split the run or time range of the selectors into chunks
+
+        Returns a list of selectors, one for each chunk.
+        """
+        for lower, upper, size in (
+            ("minrun", "maxrun", self.runs_per_request),
+            ("unixmintime", "unixmaxtime", self.seconds_per_request),
+        ):
+            if size is None or lower not in selectors or upper not in selectors:
+                continue
+            try:
+                start, stop = int(selectors[lower]), int(selectors[upper])
+            except (TypeError, ValueError):
+                continue
+            return [
+                dict(selectors, **{lower: first, upper: min(first + size - 1, stop)})
+                for first in range(start, stop + 1, size)
+            ]
+        return [selectors]
+
+    def _get_partitioned(self, stream, fmt, partitions, deadline=None):
+        """Retrieve the chunks of a split query concurrently and merge them
+
+        `partitions` is a list of (tags, selectors), where `tags` maps the
+        multi-valued selectors to the values of the chunk, see
+        `_expand_selectors`. The chunks are retried individually by the
+        `DBManager`. If one of them still fails, None is returned instead of
+        incomplete data. Values of multi-valued selectors for which the
+        database reports an error are skipped with a warning.
+        """
+        log.debug("Retrieving '%s' in %d chunks", stream, len(partitions))
+
+        def get(partition):
+            tags, selectors = partition
+            content = self._db.get(self._url(stream, fmt, selectors), deadline=deadline)
+            if tags and content and not content.startswith("ERROR"):
+                content = _tag_table(content, tags)
+            return content
+
+        workers = max(1, min(self.max_workers, len(partitions)))
+        self._db.grow_pool(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            contents = list(executor.map(get, partitions))
+
+        n_failed = sum(content is None for content in contents)
+        if n_failed:
+            log.error(
+                "Could not retrieve %d of the %d chunks of '%s'",
+                n_failed,
+                len(contents),
+                stream,
+            )
+            return None
+        values = [tuple(map(str, tags.items())) for tags, _ in partitions]
+        failed = OrderedDict()
+        for value, content in zip(values, contents):
+            if content.startswith("ERROR"):
+                failed.setdefault(value, content)
+        if failed:
+            if () in failed or len(failed) == len(set(values)):
+                return next(iter(failed.values()))
+            log.warning(
+                "Skipping %d selector value(s) of '%s': %s",
+                len(failed),
+                stream,
+                "; ".join(failed.values()),
+            )
+            contents = [c for v, c in zip(values, contents) if v not in failed]
+        return _merge_tables(contents)
+
+    @staticmethod
+    def _url(stream, fmt, selectors):
+        """The URL for a given stream, format and selectors"""
+        sel = "".join(["&{0}={1}".format(k, v) for (k, v) in selectors.items()])
+        url = "streamds/{0}.{1}?{2}".format(stream, fmt, sel[1:])
+        log.debug("URL: %s" % url)
+        return url
+
+
+class RunsMirror:
+    """An incrementally updated local copy of the `runs` stream per detector
+
+    The runs are kept sorted by run number in a `km3db.cache.MirrorCache`.
+    When the mirror is older than `max_age` seconds, the last run of the
+    detector is looked up in the `detectors` stream and only the missing runs
+    are retrieved (one request per run, concurrently), together with the
+    last stored run, which may have been incomplete. If more than `max_delta`
+    runs are missing, the whole stream is retrieved again. Runs before the
+    last stored one are not updated, use ``sync(det, refresh=True)`` to
+    retrieve all runs again.
+
+    Parameters
+    ==========
+    sds: StreamDS or None (optional)
+      The `StreamDS` instance used to access the database.
+    cache: km3db.cache.MirrorCache or None (optional)
+      The storage of the mirror, defaults to a `MirrorCache`.
+    max_age: float (optional)
+      The time in seconds in which the mirror is considered up to date.
+    max_delta: int (optional)
+      The maximum number of runs to be retrieved one by one.
+    """
+
+    def __init__(self, sds=None, cache=None, max_age=60, max_delta=50):
+        self._sds = StreamDS() if sds is None else sds
+        self.cache = km3db.cache.MirrorCache() if cache is None else cache
+        self.max_age = max_age
+        self.max_delta = max_delta
+
+    def get(self, det, run=None, deadline=None):
+        """The runs of a detector as raw database output
+
+        Returns None if the runs are not available. If `run` is given, only
+        the matching run is included. An optional `deadline` (as returned by
+        `time.time()`) applies to the update of the mirror.
+        """
+        result = self.sync(det, deadline=deadline)
+        if result is None:
+            return None
+        header, lines, runs = result
+        if run is not None:
+            run = int(run)
+            lines = lines[
+                np.searchsorted(runs, run) : np.searchsorted(runs, run, side="right")
+            ]
+        return "\n".join([header] + lines) + "\n"
+
+    def sync(self, det, force=False, deadline=None, refresh=False):
+        """Update the mirror of a detector
+
+        The mirror is updated even if it is younger than `max_age` if `force`
+        is True. All runs are retrieved again if `refresh` is True.
+
+        Returns the header line, the lines of the runs and their run numbers.
+        """
+        key = "runs:{}:{}".format(self._sds._db_url, det)
+        entry = self.cache.get(key)
+        if entry is not None and not (force or refresh):
+            synced, header, lines, runs = entry
+            if time.time() - synced < self.max_age:
+                return header, lines, runs
+        last_run = None
+        if entry is not None and not refresh:
+            last_run = self._sds.last_run(det, cached=False, deadline=deadline)
+        if last_run is None:
+            result = self._fetch_all(det, deadline)
+        else:
+            _, header, lines, runs = entry
+            stored_run = runs[-1] if len(runs) else 0
+            if last_run - stored_run > self.max_delta:
+                result = self._fetch_all(det, deadline)
+            elif last_run >= stored_run:
+                result = self._fetch_runs(
+                    det, header, lines, runs, max(stored_run, 1), last_run, deadline
+                )
+            else:
+                result = header, lines, runs
+        if result is None:
+            return None if entry is None else entry[1:]
+        self.cache.set(key, (time.time(),) + result)
+        return result
+
+    def _fetch_all(self, det, deadline=None):
+        """Retrieve all runs of a detector"""
+        log.info("Retrieving all runs of detector %s", det)
+        url = self._sds._url("runs", "txt", {"detid": det})
+        data = self._sds._db.get(url, deadline=deadline)
+        if not data or data.startswith("ERROR"):
+            log.error("Could not retrieve the runs of detector %s", det)
+            return None
+        return _sorted_runs(data)
+
+    def _fetch_runs(self, det, header, lines, runs, first, last, deadline=None):
+        """Retrieve the runs from `first` to `last` and replace/append them"""
+        log.info("Retrieving runs %d to %d of detector %s", first, last, det)
+
+        def get(run):
+            url = self._sds._url("runs", "txt", {"detid": det, "run": run})
+            return self._sds._db.get(url, deadline=deadline)
+
+        workers = max(1, min(self._sds.max_workers, last - first + 1))
+        self._sds._db.grow_pool(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            contents = list(executor.map(get, range(first, last + 1)))
+        if any(c is None or c.startswith("ERROR") for c in contents):
+            log.error("Could not retrieve the new runs of detector %s", det)
+            return None
+        try:
+            data = _merge_tables(contents)
+        except ValueError:
+            data = None
+        if not data:
+            return header, lines, runs
+        if _split_header(data) != header.split("\t"):
+            log.info("The columns of the runs stream have changed")
+            return self._fetch_all(det, deadline)
+        _, new_lines, new_runs = _sorted_runs(data)
+        keep = np.searchsorted(runs, first)
+        return (
+            header,
+            lines[:keep] + new_lines,
+            np.concatenate([runs[:keep], new_runs]),
+        )
+
+
+def _sorted_runs(data):
+    """The header line, the lines sorted by run and the run numbers"""
+    header, *lines = data.split("\n")
+    lines = [line for line in lines if line]
+    idx = header.split("\t").index("RUN")
+    runs = np.array([int(line.split("\t")[idx]) for line in lines], dtype=np.int64)
+    order = np.argsort(runs, kind="stable")
+    return header, [lines[i] for i in order], runs[order]
+
 
 class JSONDS:
     """Access to the jsonds data stored in the KM3NeT database.
@@ -238,19 +1077,22 @@ class JSONDS:
     ==========
     url: str (optional)
       The URL of the database web API
+    db: km3db.core.DBManager or None (optional)
+      The `DBManager` which carries out the requests, e.g. one with a
+      response cache or a custom retry policy. By default, the shared
+      instance for `url` is used (see `km3db.core.get_db_manager`).
 
     """
 
-    def __init__(self, url=None):
-        self._db = km3db.core.DBManager(url=url)
+    def __init__(self, url=None, db=None):
+        if db is None:
+            db = km3db.core.get_db_manager(url=url)
+        self._db = db
 
-    def get(self, url):
+    def get(self, url, deadline=None):
         "Get JSON-type content from the url"
-        content = self._db.get("jsonds/" + url)
-        try:
-            json_content = json.loads(content.decode())
-        except AttributeError:
-            json_content = json.loads(content)
+        content = self._db.get("jsonds/" + url, binary=True, deadline=deadline)
+        json_content = km3db.jsoncodec.loads(content)
         if json_content.get("Comment") is not None:
             log.warning(json_content["Comment"])
         if json_content["Result"] != "OK":
@@ -258,6 +1100,32 @@ class JSONDS:
             raise ValueError("Error while retrieving the parameter list.")
         return json_content["Data"]
 
+    def iter(self, url, batch_size=None, chunk_size=2**16, deadline=None):
+        """Iterate over JSON-type content from the url while it is retrieved
+
+        If ``Data`` is a list, its entries are yielded one by one (or in lists
+        of up to `batch_size` entries), otherwise ``Data`` is yielded as a
+        whole. The response is parsed incrementally, so the memory usage
+        does not depend on the size of the list. A `ValueError` is raised if
+        the database reports an error.
+        """
+        response = self._db.open("jsonds/" + url, deadline=deadline)
+        if response is None:
+            log.error("No data found at URL '%s'." % url)
+            return
+
+        def check(envelope, final):
+            if final and envelope.get("Comment") is not None:
+                log.warning(envelope["Comment"])
+            if ("Result" in envelope or final) and envelope.get("Result") != "OK":
+                log.critical("Error from DB: %s", envelope.get("Data"))
+                raise ValueError("Error while retrieving the parameter list.")
+            return True
+
+        with response:
+            entries = _iter_json_data(response, check, chunk_size=chunk_size)
+            yield from entries if batch_size is None else _batched(entries, batch_size)
+
 
 class CLBMap:
     renamemap = dict(
@@ -277,7 +1145,7 @@ class CLBMap:
         #     # if _det_oid is not None:
         #     #     det_oid = _det_oid
         self.det_oid = det_oid
-        sds = StreamDS(container="nt")
+        sds = StreamDS(container="records")
         self._data = sds.get("clbmap", detoid=det_oid, renamemap=self.renamemap)
         self._by = {}
 
@@ -329,25 +1197,29 @@ class CLBMap:
         self._by[by] = data
 
 
-def lru_cache(func):
-    """Poor mans lru_cache for compatiblity"""
-    cache = {}
+# kept for backwards compatibility
+lru_cache = memoize
+
+
+@memoize(maxsize=None)
+def _streamds():
+    """The `StreamDS` instance shared by the helper functions"""
+    return StreamDS()
 
-    @wraps(func)
-    def wrapper(*args):
-        key = tuple(args)
-        if key not in cache:
-            cache[key] = func(*args)
-        return cache[key]
 
-    return wrapper
+@memoize(maxsize=None)
+def _apiv2():
+    """The `APIv2` instance shared by the helper functions"""
+    return APIv2()
 
 
-@lru_cache
+@memoize(maxsize=1024)
 def clbupi2compassupi(clb_upi):
     """Return Compass UPI from CLB UPI."""
-    sds = StreamDS(container="nt")
-    upis = [i.content_upi for i in sds.integration(container_upi=clb_upi)]
+    upis = [
+        i.content_upi
+        for i in _streamds().get("integration", container="nt", container_upi=clb_upi)
+    ]
     compass_upis = [upi for upi in upis if ("AHRS" in upi) or ("LSM303" in upi)]
     if len(compass_upis) > 1:
         log.warning(
@@ -357,11 +1229,13 @@ def clbupi2compassupi(clb_upi):
     return compass_upis[0]
 
 
-@lru_cache
-def todetoid(det_id):
+@memoize(maxsize=256, ttl=3600, ignore=("deadline",))
+def todetoid(det_id, deadline=None):
     """Convert det OID (e.g. D_ORCA006) to det ID (e.g. 49)
 
-    If a det OID is provided it will simple be returned.
+    If a det OID is provided it will simple be returned. An optional
+    `deadline` (as returned by `time.time()`, passed as keyword) can be
+    specified for the lookup.
     """
     try:
         det_id = int(det_id)
@@ -369,22 +1243,24 @@ def todetoid(det_id):
         # assume it's an OID
         return det_id
 
-    detectors = StreamDS(container="nt").get("detectors")
+    detectors = _streamds().get("detectors", container="nt", deadline=deadline)
     for detector in detectors:
         if detector.serialnumber == det_id:
             return detector.oid
     log.error("No detector with det ID '{}' found to look up its OID".format(det_id))
 
 
-@lru_cache
-def todetid(det_oid):
+@memoize(maxsize=256, ttl=3600, ignore=("deadline",))
+def todetid(det_oid, deadline=None):
     """Convert det ID (e.g. 49) to det OID (e.g. D_ORCA006)
 
-    If a det OID is provided it will simple be returned.
+    If a det OID is provided it will simple be returned. An optional
+    `deadline` (as returned by `time.time()`, passed as keyword) can be
+    specified for the lookup.
     """
     if isinstance(det_oid, int):
         return det_oid
-    detectors = StreamDS(container="nt").get("detectors")
+    detectors = _streamds().get("detectors", container="nt", deadline=deadline)
     for detector in detectors:
         if detector.oid == det_oid:
             return detector.serialnumber
@@ -401,35 +1277,626 @@ def tonum(value):
     return value
 
 
-def tonamedtuples(name, text, renamemap=None):
+# the containers which can be served from a `ResultCache` or a `RunsMirror`
+_cached_containers = ("pd", "nt", "records", "np", "arrow")
+
+
+def _check_columns(header, columns, renamemap=None):
+    """Check whether the requested columns exist, logs an error if not"""
+    try:
+        _column_indices(header, columns, renamemap)
+    except ValueError as e:
+        log.error(e)
+        return False
+    return True
+
+
+def _project_text(text, columns):
+    """Keep only the given columns of tab separated database output"""
+    lines = [line for line in text.split("\n") if line]
+    header = lines[0].split("\t")
+    indices = _column_indices(header, columns)
+    values = _split_columns(lines, len(header), indices)
+    return "".join(line + "\n" for line in map("\t".join, zip(*values)))
+
+
+def _split_header(data):
+    """The column names of database output (str or bytes)"""
+    if isinstance(data, bytes):
+        return data.partition(b"\n")[0].decode("utf-8").split("\t")
+    return data.partition("\n")[0].split("\t")
+
+
+def _is_multi_valued(value):
+    """Whether a selector value is a list, tuple or range of values"""
+    return isinstance(value, (list, tuple, range))
+
+
+def _expand_selectors(selectors):
+    """Expand multi-valued selectors into single-valued ones
+
+    Returns a list of (tags, selectors), one for each combination of the
+    values, where `tags` is an `OrderedDict` of the multi-valued selectors
+    and the values of the combination.
+    """
+    expanded = [(OrderedDict(), OrderedDict())]
+    for key, value in selectors.items():
+        if _is_multi_valued(value):
+            expanded = [
+                (OrderedDict(tags, **{key: v}), OrderedDict(sels, **{key: v}))
+                for tags, sels in expanded
+                for v in value
+            ]
+        else:
+            for _, sels in expanded:
+                sels[key] = value
+    return expanded
+
+
+def _tag_table(content, tags):
+    """Prepend a column for each tag to database output
+
+    The columns are named after the selectors (uppercase), tags for which the
+    output already has a column are skipped.
+    """
+    first, _, body = content.partition("\n")
+    header = {name.lower() for name in first.split("\t")}
+    tags = [(k, v) for k, v in tags.items() if k.lower() not in header]
+    if not tags:
+        return content
+    names = "".join(k.upper() + "\t" for k, _ in tags)
+    prefix = "".join(str(v) + "\t" for _, v in tags)
+    lines = [line for line in body.split("\n") if line]
+    return names + first + "\n" + "".join(prefix + line + "\n" for line in lines)
+
+
+def _merge_tables(contents):
+    """Concatenate database outputs which share the same header"""
+    header = None
+    parts = []
+    for content in contents:
+        if not content:
+            continue
+        first, sep, body = content.partition("\n")
+        if header is None:
+            header = first
+            parts.append(first + "\n")
+        elif first != header:
+            raise ValueError("The headers of the chunks do not match")
+        if body:
+            parts.append(body if body.endswith("\n") else body + "\n")
+    return "".join(parts)
+
+
+def _iter_text(fobj, chunk_size=2**16):
+    """Yield the content of a binary file-like object as str chunks
+
+    The content is read in chunks and decoded incrementally as UTF-8. For
+    HTTP responses, an `IncompleteRead` is raised if the body ended early.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    read = getattr(fobj, "read1", fobj.read)
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    missing = getattr(fobj, "length", None)
+    if missing:
+        raise IncompleteRead(b"", missing)
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _iter_lines(fobj, chunk_size=2**16):
+    """Yield the non-empty lines of a binary file-like object, see `_iter_text`"""
+    pending = ""
+    for text in _iter_text(fobj, chunk_size=chunk_size):
+        lines = (pending + text).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if pending:
+        yield pending
+
+
+def _iter_json_data(fobj, check, key="Data", chunk_size=2**16):
+    """Yield the entries of the `key` list of a JSON object while it is read
+
+    The other members of the object (the envelope) are parsed as a whole and
+    passed to ``check(envelope, final)`` right before the first entry (with
+    the members read so far) and at the end (with all members and `final`
+    set to True). The iteration stops if `check` returns False. If the value
+    of `key` is not a list, it is yielded as a whole after the final check.
+
+    Only the current entry is kept in memory, each entry is parsed by the
+    `json` C scanner once it has been read completely.
+    """
+    decoder = json.JSONDecoder()
+    text = _iter_text(fobj, chunk_size=chunk_size)
+    buf = ""
+    pos = 0
+
+    def more(n_chars):
+        """Read at least `n_chars` characters, False if at the end"""
+        nonlocal buf, pos
+        buf = buf[pos:]
+        pos = 0
+        n_read = 0
+        for chunk in text:
+            buf += chunk
+            n_read += len(chunk)
+            if n_read >= n_chars:
+                break
+        return n_read > 0
+
+    def peek():
+        """Skip whitespace and return the next character"""
+        nonlocal pos
+        if pos < len(buf) and buf[pos] not in _json_whitespace_chars:
+            return buf[pos]
+        while True:
+            pos = _json_whitespace.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if not more(1):
+                raise ValueError("Unexpected end of the JSON data")
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(
+                "Expected '{}' in the JSON data, got '{}'".format(char, buf[pos])
+            )
+        pos += 1
+
+    def value():
+        """Parse the next value, reading more data until it is complete"""
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if not more(max(chunk_size, len(buf) - pos)):
+                    raise
+                continue
+            # a number at the end of the buffer might continue in the next chunk
+            if buf[end : end + 1] not in _json_terminators and more(1):
+                continue
+            pos = end
+            return obj
+
+    envelope = {}
+    is_list = False
+    expect("{")
+    n_members = 0
+    while peek() != "}":
+        if n_members:
+            expect(",")
+        n_members += 1
+        name = value()
+        expect(":")
+        if name == key and peek() == "[":
+            is_list = True
+            if not check(envelope, False):
+                return
+            expect("[")
+            if peek() != "]":
+                yield value()
+                while peek() == ",":
+                    pos += 1
+                    yield value()
+            expect("]")
+        else:
+            envelope[name] = value()
+    if not check(envelope, True):
+        return
+    if not is_list and key in envelope:
+        yield envelope[key]
+
+
+_json_whitespace = re.compile(r"[ \t\n\r]*")
+_json_whitespace_chars = frozenset(" \t\n\r")
+_json_terminators = frozenset(",:]}") | _json_whitespace_chars
+
+
+def _batched(iterable, n):
+    """Yield lists of up to `n` items"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tonamedtuples(name, text, renamemap=None, columns=None, compact=False):
     """Creates a list of namedtuples from database output
 
+    The values are converted like in `tonum`.
+
     Parameters
     ----------
     name: str
-      Name of the namedtuple
+      Name of the record class
     text: str
       Raw output from the database (tab separated values
       and the first line being the header)
     renamemap: dict(str: str) or None (default)
       Rename the fields according to this map.
+    columns: list(str) or None (default)
+      Only parse the given columns, see `StreamDS.get`.
+    compact: bool (default: False)
+      Return `Records` instead, which store the values in compact columns
+      and create namedtuple-like rows on access.
     """
     if renamemap is None:
         renamemap = {}
     lines = text.split("\n")
-    cls = namedtuple(name, [renamemap.get(s, s.lower()) for s in lines.pop(0).split()])
-    entries = []
-    for line in lines:
-        if not line:
-            continue
-        entries.append(cls(*map(tonum, line.split("\t"))))
-    return entries
+    header = lines.pop(0).split()
+    lines = [line for line in lines if line]
+    indices = _column_indices(header, columns, renamemap)
+    fields = tuple(renamemap.get(header[i], header[i].lower()) for i in indices)
+    values = _split_columns(lines, len(header), indices)
+    values = list(map(_tonum_column, values))
+    if compact:
+        return Records(_record_class(name, fields), values, len(lines))
+    return list(map(_namedtuple_class(name, fields)._make, zip(*values)))
+
+
+def _tonum_column(values):
+    """Convert a list of strings like `tonum` and store them compactly
+
+    Integers and floats are stored in arrays, other columns in lists with
+    repeated values being shared.
+    """
+    try:
+        return array("q", map(int, values))
+    except (ValueError, OverflowError):
+        pass
+    column = [
+        (
+            tonum(value)
+            if value[:1] in _numeric_starts or not value[:1].isascii()
+            else value
+        )
+        for value in values
+    ]
+    if all(type(value) is float for value in column):
+        return array("d", column)
+    return _dedupe(column)
+
+
+# the ASCII characters at the start of strings which might be converted by
+# `tonum` (non-ASCII digits and whitespace are also accepted by int/float)
+_numeric_starts = frozenset("0123456789+-.nNiI" + string.whitespace)
+
+
+def _dedupe(values):
+    """Replace equal strings by the same object
+
+    Numbers are kept as they are, since e.g. ``5`` and ``5.0`` are equal.
+    """
+    unique = {}
+    return [
+        unique.setdefault(value, value) if type(value) is str else value
+        for value in values
+    ]
+
+
+class Records(Sequence):
+    """A compact sequence of records with namedtuple-like rows
+
+    The values are stored per column (numbers in `array.array`) and the rows
+    are lightweight `Record` views, which are created on access.
+
+    Parameters
+    ----------
+    cls: type
+      The `Record` subclass of the rows, see `_record_class`.
+    columns: list
+      A sequence of values for each field of `cls`.
+    length: int
+      The number of rows.
+    """
+
+    __slots__ = ("_cls", "_columns", "_length")
+
+    def __init__(self, cls, columns, length):
+        self._cls = cls
+        self._columns = columns
+        self._length = length
+
+    @property
+    def _fields(self):
+        return self._cls._fields
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            columns = [column[idx] for column in self._columns]
+            return Records(self._cls, columns, len(range(self._length)[idx]))
+        if idx < 0:
+            idx += self._length
+        if not 0 <= idx < self._length:
+            raise IndexError("record index out of range")
+        return self._cls(self, idx)
+
+    def __iter__(self):
+        cls = self._cls
+        for idx in range(self._length):
+            yield cls(self, idx)
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, (str, Record)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "[{}]".format(", ".join(map(repr, self)))
+
+    def __reduce__(self):
+        cls = self._cls
+        return (
+            _make_records,
+            (cls.__name__, cls._fields, self._columns, self._length),
+        )
+
+
+def _make_records(name, fields, columns, length):
+    """Recreate pickled `Records`"""
+    return Records(_record_class(name, fields), columns, length)
+
+
+@total_ordering
+class Record:
+    """A row of `Records` which behaves like a read-only namedtuple"""
+
+    __slots__ = ("_records", "_idx")
+    _fields = ()
+
+    def __init__(self, records, idx):
+        self._records = records
+        self._idx = idx
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        idx = self._idx
+        return (column[idx] for column in self._records._columns)
+
+    def __getitem__(self, idx):
+        return tuple(self)[idx]
 
+    def __eq__(self, other):
+        if isinstance(other, (tuple, Record)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
 
-def topandas(text):
-    """Create a DataFrame from database output"""
-    return km3db.extras.pandas().read_csv(
-        io.StringIO(text), sep="\t", dtype={"PROMISID": "str"}
+    def __lt__(self, other):
+        if isinstance(other, (tuple, Record)):
+            return tuple(self) < tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return "{}({})".format(
+            type(self).__name__,
+            ", ".join("{}={!r}".format(f, v) for f, v in zip(self._fields, self)),
+        )
+
+    def __reduce__(self):
+        return (tuple, (tuple(self),))
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+
+@memoize(maxsize=256)
+def _record_class(name, fields):
+    """The `Record` subclass for a given name and tuple of field names"""
+    attrs = {"__slots__": (), "_fields": fields}
+    for idx, field in enumerate(fields):
+        attrs[field] = property(_field_getter(idx))
+    return type(name, (Record,), attrs)
+
+
+def _field_getter(idx):
+    def getter(self):
+        return self._records._columns[idx][self._idx]
+
+    return getter
+
+
+@memoize(maxsize=256)
+def _namedtuple_class(name, fields):
+    """The namedtuple class for a given name and tuple of field names"""
+    return namedtuple(name, fields)
+
+
+def tonumpy(text, renamemap=None, columns=None):
+    """Creates a numpy structured array from database output
+
+    The types are inferred per column: integers (int64) if all values are
+    integers, floats (float64) if all values are numbers or empty (NaN) and
+    `str` objects otherwise (object arrays, equal strings are shared). The
+    field names are lowercased, just like in `tonamedtuples`.
+
+    Parameters
+    ----------
+    text: str
+      Raw output from the database (tab separated values
+      and the first line being the header)
+    renamemap: dict(str: str) or None (default)
+      Rename the fields according to this map.
+    columns: list(str) or None (default)
+      Only parse the given columns, see `StreamDS.get`.
+    """
+    if renamemap is None:
+        renamemap = {}
+    lines = [line for line in text.split("\n") if line]
+    header = lines.pop(0).split("\t")
+    indices = _column_indices(header, columns, renamemap)
+    names = [renamemap.get(header[i], header[i].lower()) for i in indices]
+    values = _split_columns(lines, len(header), indices)
+    columns = [
+        _infer_column(column, field=header[idx]) for idx, column in zip(indices, values)
+    ]
+    arr = np.empty(len(lines), dtype=[(n, c.dtype) for n, c in zip(names, columns)])
+    for name, column in zip(names, columns):
+        arr[name] = column
+    return arr
+
+
+def _column_indices(header, columns=None, renamemap=None):
+    """The indices of the requested columns in the header
+
+    The columns can be given by their name in the database output or their
+    field name (lowercased or renamed via `renamemap`). All columns are
+    selected if `columns` is None. Raises a `ValueError` for unknown columns.
+    """
+    if columns is None:
+        return list(range(len(header)))
+    if isinstance(columns, str):
+        columns = [columns]
+    if renamemap is None:
+        renamemap = {}
+    lookup = {}
+    for idx, name in enumerate(header):
+        lookup.setdefault(name.lower(), idx)
+        lookup.setdefault(renamemap.get(name, name).lower(), idx)
+    indices = [lookup.get(str(column).lower()) for column in columns]
+    unknown = [c for c, idx in zip(columns, indices) if idx is None]
+    if unknown:
+        raise ValueError(
+            "Unknown column(s): {} (available: {})".format(
+                ", ".join(map(str, unknown)), ", ".join(header)
+            )
+        )
+    return indices
+
+
+def _split_columns(lines, n_columns, indices):
+    """Split tab separated lines into the columns with the given indices
+
+    The lines are only split up to the last requested column.
+    """
+    if set(map(methodcaller("count", "\t"), lines)) - {n_columns - 1}:
+        raise ValueError("Inconsistent number of columns in the database output")
+    if not lines:
+        return [[] for _ in indices]
+    last = max(indices, default=-1)
+    if last == n_columns - 1:
+        cells = "\t".join(lines).split("\t")
+        return [cells[idx::n_columns] for idx in indices]
+    rows = list(map(methodcaller("split", "\t", last + 1), lines))
+    return [list(map(itemgetter(idx), rows)) for idx in indices]
+
+
+def _infer_column(values, field=None):
+    """Convert a list of strings to int64, float64 or an array of strings
+
+    Strings are stored in object arrays with equal values being shared.
+
+    The parsing is done by `int()` and `float()`, so the same values are
+    accepted as in `tonum`. Empty values in float columns become NaN.
+    """
+    if field not in _string_fields:
+        try:
+            return np.fromiter(map(int, values), np.int64, len(values))
+        except (ValueError, OverflowError):
+            pass
+        try:
+            return np.fromiter(map(float, values), np.float64, len(values))
+        except ValueError:
+            pass
+        if "" in values:
+            try:
+                values_ = [v or "nan" for v in values]
+                return np.fromiter(map(float, values_), np.float64, len(values))
+            except ValueError:
+                pass
+    column = np.empty(len(values), dtype=object)
+    column[:] = _dedupe(values)
+    return column
+
+
+# columns which are kept as strings, even if they look like numbers
+_string_fields = ("PROMISID",)
+
+
+def topandas(text, columns=None, dtype=None):
+    """Create a DataFrame from database output
+
+    If `columns` is given, only these columns are parsed (in that order).
+    The types of the columns are inferred by pandas unless they are given in
+    `dtype` (a dict of column name and dtype, see `pandas_schema`).
+    """
+    usecols = None
+    if columns is not None:
+        header = _split_header(text)
+        usecols = [header[idx] for idx in _column_indices(header, columns)]
+    dtypes = dict(dtype or {})
+    dtypes.update((f, "str") for f in _string_fields)
+    df = km3db.extras.pandas().read_csv(
+        io.StringIO(text), sep="\t", dtype=dtypes, usecols=usecols
+    )
+    return df if usecols is None else df[usecols]
+
+
+def pandas_schema(df, max_category_ratio=0.5):
+    """The dtypes of the columns of a DataFrame created by `topandas`
+
+    String columns with a low cardinality (at most `max_category_ratio`
+    distinct values per row) are turned into categoricals. The returned dict
+    can be passed to `topandas` (`dtype=...`) to skip the type inference.
+    """
+    schema = OrderedDict()
+    for name, dtype in df.dtypes.items():
+        if dtype.kind in "biuf" or name in _string_fields:
+            schema[name] = str(dtype)
+        elif dtype.kind in "OT" and df[name].nunique() <= max_category_ratio * len(df):
+            schema[name] = "category"
+        else:
+            schema[name] = "str"
+    return schema
+
+
+def toarrow(data, columns=None):
+    """Create a `pyarrow.Table` from database output (str or bytes)
+
+    The table is built by the multithreaded Arrow CSV reader, the column
+    names are kept as they are. If `columns` is given, only these columns are
+    parsed (in that order).
+    """
+    pyarrow = km3db.extras.pyarrow()
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    include_columns = None
+    if columns is not None:
+        header = data.partition(b"\n")[0].decode("utf-8").split("\t")
+        include_columns = [header[idx] for idx in _column_indices(header, columns)]
+    return pyarrow.csv.read_csv(
+        pyarrow.BufferReader(data),
+        parse_options=pyarrow.csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types={f: pyarrow.string() for f in _string_fields},
+            include_columns=include_columns,
+        ),
     )
 
 
@@ -448,7 +1915,7 @@ def df_to_sarray(df):
     """
 
     for dtype in df.dtypes:
-        if dtype is np.dtype("O"):
+        if dtype.kind == "O" or dtype.name == "category":
             log.critical(
                 "At least one column contains strings, "
                 "which are currently not supported in the HDF5 backend. "
@@ -467,7 +1934,7 @@ def df_to_sarray(df):
 
 def show_compass_calibration(clb_upi, version="3"):
     """Show compass calibration data for given `clb_upi`."""
-    db = km3db.core.DBManager()
+    db = km3db.core.get_db_manager()
     compass_upi = clbupi2compassupi(clb_upi)
     compass_model = compass_upi.split("/")[1]
     print("Compass UPI: {}".format(compass_upi))
@@ -494,8 +1961,24 @@ def show_compass_calibration(clb_upi, version="3"):
             print("{}: {}".format(name, value))
 
 
-def detx(det_id, pcal=0, rcal=0, tcal=0, acal=0, ccal=0, scal=0, version=5):
-    """Retrieve the calibrated detector file for the given detector ID"""
+def detx(
+    det_id,
+    pcal=0,
+    rcal=0,
+    tcal=0,
+    acal=0,
+    ccal=0,
+    scal=0,
+    version=5,
+    deadline=None,
+    db=None,
+):
+    """Retrieve the calibrated detector file for the given detector ID
+
+    An optional `deadline` (as returned by `time.time()`) can be specified,
+    after which the request is abandoned. The request is carried out by the
+    given `DBManager` or by the shared one.
+    """
 
     print(
         "Retrieving DETX for {} with: pcal={}, rcal={}, tcal={}, acal={}, ccal={}, scal={}".format(
@@ -519,13 +2002,26 @@ def detx(det_id, pcal=0, rcal=0, tcal=0, acal=0, ccal=0, scal=0, version=5):
         )
     )
 
-    return km3db.core.DBManager().get(url)
+    if db is None:
+        db = km3db.core.get_db_manager()
+    return db.get(url, deadline=deadline)
+
 
+def detx_for_run(det_id, run, version=5, deadline=None, db=None):
+    """Retrieve the calibrate detector file for given run
 
-def detx_for_run(det_id, run, version=5):
-    """Retrieve the calibrate detector file for given run"""
-    api = APIv2()
-    cals = api.RunCalibration(DetOId=todetoid(det_id), Run=run, Ranking=1)
+    An optional `deadline` (as returned by `time.time()`) can be specified,
+    after which the requests are abandoned. The calibrations and the detector
+    file are retrieved by the given `DBManager` or by the shared one.
+    """
+    api = _apiv2() if db is None else APIv2(db=db)
+    api._catalog(deadline)  # the endpoint lookup below cannot pass the deadline
+    cals = api.RunCalibration(
+        DetOId=todetoid(det_id, deadline=deadline),
+        Run=run,
+        Ranking=1,
+        deadline=deadline,
+    )
     calibration_ids = dict()
     # type is e.g. "COMPASS_CALIBRATION" or "STATUS_CALIBRATION", corresponding to "ccal" or "scal"
     for cal in cals:
@@ -540,4 +2036,6 @@ def detx_for_run(det_id, run, version=5):
         ccal=calibration_ids.get("COMPASS_CALIBRATION", 0),
         scal=calibration_ids.get("STATUS_CALIBRATION", 0),
         version=version,
+        deadline=deadline,
+        db=db,
     )
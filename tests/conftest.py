@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+
+def pytest_configure(config):
+    # keep the on-disk caches of the tests away from the user's cache
+    os.environ["KM3DB_CACHE_DIR"] = tempfile.mkdtemp(prefix="km3db-tests-")
@@ -0,0 +1,221 @@
+import asyncio
+import inspect
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+
+from km3db import AsyncAPIv2, AsyncDBManager, AsyncJSONDS, AsyncStreamDS
+from km3net_testdata import data_path
+
+
+class TestAsyncDBManager(unittest.TestCase):
+    @patch("km3db.core.DBManager")
+    def test_get(self, db_manager_mock):
+        db_manager_mock.return_value.get.side_effect = lambda url, **kwargs: url
+        db = AsyncDBManager()
+
+        async def fetch():
+            return await asyncio.gather(*[db.get("foo/{}".format(i)) for i in range(5)])
+
+        assert ["foo/{}".format(i) for i in range(5)] == asyncio.run(fetch())
+
+    @patch("km3db.core.DBManager")
+    def test_concurrency_is_bounded(self, db_manager_mock):
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+
+        def get(url, **kwargs):
+            with lock:
+                in_flight.append(url)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(url)
+            return url
+
+        db_manager_mock.return_value.get.side_effect = get
+
+        async def fetch():
+            async with AsyncDBManager(max_concurrency=3) as db:
+                return await asyncio.gather(*[db.get(str(i)) for i in range(20)])
+
+        assert 20 == len(asyncio.run(fetch()))
+        assert 3 == max(max_in_flight)
+
+
+class TestAsyncStreamDSOffline(unittest.TestCase):
+    @patch("km3db.core.DBManager")
+    def setUp(self, db_manager_mock):
+        with open(data_path("db/streamds_output.txt"), "r") as fobj:
+            self.streamds_meta = fobj.read()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        patcher = patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.threads = []
+        self.db = db_manager_mock.return_value
+        self.db.get.side_effect = self._get
+        self.sds = AsyncStreamDS(container="nt")
+
+    def _get(self, url, deadline=None):
+        self.threads.append(threading.current_thread().name)
+        if url.startswith("streamds/detectors"):
+            return "OID\tSERIALNUMBER\tLASTRUN\nD_ORCA006\t49\t100\n"
+        return self.streamds_meta
+
+    def test_streams(self):
+        assert 30 == len(self.sds.streams)
+
+    def test_stream_functions_are_coroutine_functions(self):
+        assert asyncio.iscoroutinefunction(self.sds.runs)
+        self.sds.streams
+        assert self.sds.runs.__doc__.startswith("Shows all runs")
+        assert "detid" in str(inspect.signature(self.sds.runs))
+
+    def test_catalog_is_loaded_in_the_thread_pool(self):
+        runs = asyncio.run(self.sds.runs(detid=49))
+        assert 30 == len(runs)
+        assert 2 == len(self.threads)
+        assert all(name.startswith("km3db") for name in self.threads)
+        with self.assertRaises(AttributeError):
+            asyncio.run(self.sds.foo())
+
+    def test_methods(self):
+        assert 100 == asyncio.run(self.sds.last_run(49, cached=False))
+        assert ["streamds/detectors.txt?"] == [
+            c[0][0] for c in self.db.get.call_args_list
+        ]
+        assert "det" in str(inspect.signature(self.sds.last_run))
+        asyncio.run(self.sds.help("runs"))
+
+    def test_attributes(self):
+        assert 4 == self.sds.max_workers
+        assert self.sds.runs_mirror is None
+        self.sds.streams
+        assert 4 == self.sds.max_workers
+        assert 24 * 60 * 60 == self.sds.catalog_ttl
+
+    def test_iter(self):
+        self.db.open.return_value = io.BytesIO(b"RUN\tNAME\n1\ta\n2\tb\n")
+
+        async def collect():
+            return [row async for row in self.sds.iter("runs", detid=49)]
+
+        assert [1, 2] == [row.run for row in asyncio.run(collect())]
+
+    def test_get(self):
+        streams = asyncio.run(self.sds.get("streamds"))
+        assert 30 == len(streams)
+        assert "detectors" == streams[0].stream
+
+
+class TestAsyncAPIv2Offline(unittest.TestCase):
+    catalog = json.dumps(
+        {
+            "Error": {"Code": "OK"},
+            "Data": [
+                {
+                    "Name": "RunCalibration",
+                    "Description": "Calibrations of a run",
+                    "Selectors": ["DetOId -> Detector", "Run -> Run number"],
+                    "Schema": ["Run -> Integer", "Type -> String"],
+                }
+            ],
+        }
+    )
+
+    @patch("km3db.core.DBManager")
+    def setUp(self, db_manager_mock):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        patcher = patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.threads = []
+        self.db = db_manager_mock.return_value
+        self.db.get.side_effect = self._get
+        self.api = AsyncAPIv2()
+
+    def _get(self, url, binary=False, deadline=None):
+        self.threads.append(threading.current_thread().name)
+        if url == "apiv2.1.0/":
+            return self.catalog.encode()
+        return json.dumps({"Error": {"Code": "OK"}, "Data": [url]}).encode()
+
+    def test_endpoints(self):
+        data = asyncio.run(self.api.RunCalibration(DetOId="D_ORCA006", Run=1))
+        assert ["apiv2.1.0/RunCalibration/s?&DetOId=D_ORCA006&Run=1"] == data
+        assert 2 == len(self.threads)
+        assert all(name.startswith("km3db") for name in self.threads)
+        assert "container" in str(inspect.signature(self.api.RunCalibration))
+        with self.assertRaises(AttributeError):
+            asyncio.run(self.api.Foo())
+        with self.assertRaises(AttributeError):
+            self.api.Foo
+
+    def test_attributes(self):
+        assert 4 == self.api.max_workers
+        self.api.endpoints
+        assert 4 == self.api.max_workers
+
+    def test_batch(self):
+        results = asyncio.run(
+            self.api.batch("RunCalibration", [dict(Run=1), dict(Run=2)])
+        )
+        assert [None, None] == [r.error for r in results]
+        assert "selectors" in str(inspect.signature(self.api.batch))
+
+    def test_iter(self):
+        self.db.open.return_value = io.BytesIO(
+            json.dumps({"Error": {"Code": "OK"}, "Data": [1, 2, 3]}).encode()
+        )
+
+        async def collect():
+            return [item async for item in self.api.iter("RunCalibration", Run=1)]
+
+        assert [1, 2, 3] == asyncio.run(collect())
+
+
+class TestAsyncJSONDSOffline(unittest.TestCase):
+    @patch("km3db.core.DBManager")
+    def setUp(self, db_manager_mock):
+        self.db = db_manager_mock.return_value
+        self.jsonds = AsyncJSONDS()
+
+    def test_get(self):
+        self.db.get.return_value = b'{"Result": "OK", "Data": [1, 2]}'
+        assert [1, 2] == asyncio.run(self.jsonds.get("foo", deadline=123))
+        self.db.get.assert_called_once_with("jsonds/foo", binary=True, deadline=123)
+
+    def test_iter(self):
+        content = {"Result": "OK", "Data": [{"a": 1}, {"a": 2}, {"a": 3}]}
+        self.db.open.return_value = io.BytesIO(json.dumps(content).encode())
+
+        async def collect():
+            return [item async for item in self.jsonds.iter("foo", batch_size=2)]
+
+        assert [content["Data"][:2], content["Data"][2:]] == asyncio.run(collect())
+        self.db.open.assert_called_once_with("jsonds/foo", deadline=None)
+
+
+class TestAsyncDBManagerOwnership(unittest.TestCase):
+    @patch("km3db.core.DBManager")
+    def test_shared_manager_is_not_closed(self, db_manager_mock):
+        db = AsyncDBManager(max_concurrency=16)
+        db.db.grow_pool.assert_called_with(16)
+        db.close()
+        db.db.close.assert_not_called()
+
+    @patch("km3db.core.DBManager")
+    def test_private_manager_is_closed(self, db_manager_mock):
+        db = AsyncDBManager(max_concurrency=16, shared=False)
+        assert 16 == db_manager_mock.call_args[1]["pool_size"]
+        db.close()
+        db.db.close.assert_called_once_with()
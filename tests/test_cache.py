@@ -0,0 +1,202 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from mock import patch
+
+from km3db.cache import DiskCache, ResponseCache, cache_dir, memoize
+from km3db.core import canonical_url
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = DiskCache(path=self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_set_and_get(self):
+        self.cache.set("foo", b"bar")
+        assert b"bar" == self.cache.get("foo")
+        assert self.cache.get("baz") is None
+        assert "default" == self.cache.get("baz", default="default")
+        info = self.cache.cache_info()
+        assert 1 == info.hits
+        assert 2 == info.misses
+        assert info.currsize > 0
+
+    def test_no_temporary_files_are_left(self):
+        self.cache.set("foo", b"bar")
+        assert 1 == len(os.listdir(self.tmpdir.name))
+
+    def test_expiry(self):
+        self.cache.set("foo", b"bar", ttl=-1)
+        assert self.cache.get("foo") is None
+        assert 0 == len(self.cache)
+
+    def test_shared_between_instances(self):
+        self.cache.set("foo", [1, 2, 3])
+        assert [1, 2, 3] == DiskCache(path=self.tmpdir.name).get("foo")
+
+    def test_lru_eviction(self):
+        self.cache.set("a", b"a" * 1000)
+        self.cache.set("b", b"b" * 1000)
+        size = self.cache.cache_info().currsize
+        self.cache.max_bytes = size + size // 4
+        past = time.time() - 100
+        os.utime(self.cache._filename("a"), (past, past))
+        os.utime(self.cache._filename("b"), (past + 1, past + 1))
+        self.cache.get("a")  # "b" is now the least recently used one
+        self.cache.set("c", b"c" * 1000)
+        assert self.cache.get("a") is not None
+        assert self.cache.get("b") is None
+        assert self.cache.get("c") is not None
+
+    def test_size_is_estimated_between_scans(self):
+        with patch.object(self.cache, "_entries", wraps=self.cache._entries) as scan:
+            for key in "abcdef":
+                self.cache.set(key, b"x" * 1000)
+            assert 1 == scan.call_count
+            self.cache.max_bytes = 3 * self.cache.cache_info().currsize // 4
+            assert 2 == scan.call_count
+            self.cache.set("g", b"x" * 1000)
+            assert 3 == scan.call_count
+            assert self.cache.cache_info().currsize <= self.cache.max_bytes
+            self.cache.scan_interval = 0
+            self.cache.set("h", b"x")
+            assert 5 == scan.call_count
+
+    def test_clear(self):
+        self.cache.set("foo", b"bar")
+        self.cache.clear()
+        assert 0 == len(self.cache)
+        assert 0 == self.cache.hits
+
+    def test_default_location(self):
+        with patch.dict(os.environ, {"KM3DB_CACHE_DIR": self.tmpdir.name}):
+            assert self.tmpdir.name == cache_dir()
+            assert DiskCache().path.startswith(self.tmpdir.name)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(
+            path=self.tmpdir.name,
+            ttls=[(r"^detx/", None), (r"^streamds/runs\.", 0)],
+            default_ttl=10,
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_ttl(self):
+        assert self.cache.ttl("detx/49?tcal=1") is None
+        assert 0 == self.cache.ttl("streamds/runs.txt?detid=49")
+        assert 10 == self.cache.ttl("streamds/detectors.txt")
+
+    def test_store_and_lookup(self):
+        self.cache.store("detx/49", b"foo")
+        assert b"foo" == self.cache.lookup("detx/49")
+        assert self.cache.lookup("detx/49", binary=True) is None
+
+    def test_zero_ttl_is_not_cached(self):
+        self.cache.store("streamds/runs.txt?detid=49", b"foo")
+        assert self.cache.lookup("streamds/runs.txt?detid=49") is None
+        assert 0 == len(self.cache)
+
+
+class TestCanonicalURL(unittest.TestCase):
+    def test_sorted_parameters(self):
+        assert "streamds/runs.txt?detid=49&run=1" == canonical_url(
+            "streamds/runs.txt?run=1&detid=49"
+        )
+        assert canonical_url("a?b=1&c=2") == canonical_url("a?&c=2&b=1")
+        assert "streamds" == canonical_url("streamds")
+        assert "a?b=c d" == canonical_url("a?b=c%20d")
+
+
+class TestMemoize(unittest.TestCase):
+    def test_memoize(self):
+        calls = []
+
+        @memoize
+        def f(x, y=1):
+            calls.append(x)
+            return x + y
+
+        assert 3 == f(2)
+        assert 3 == f(2)
+        assert 4 == f(2, y=2)
+        assert 4 == f(2, y=2)
+        assert [2, 2] == calls
+        assert (2, 2, 128, 2) == tuple(f.cache_info())
+
+    def test_ignored_kwargs(self):
+        calls = []
+
+        @memoize(ignore=("deadline",))
+        def f(x, deadline=None):
+            calls.append(deadline)
+            return x
+
+        assert 1 == f(1, deadline=10)
+        assert 1 == f(1, deadline=20)
+        assert 1 == f(1)
+        assert [10] == calls
+
+    def test_lru_eviction(self):
+        @memoize(maxsize=2)
+        def f(x):
+            return x
+
+        f(1)
+        f(2)
+        f(1)
+        f(3)  # evicts 2
+        assert 2 == f.cache_info().currsize
+        f(1)
+        assert 2 == f.cache_info().hits
+        f(2)
+        assert 4 == f.cache_info().misses
+
+    def test_ttl(self):
+        @memoize(ttl=10)
+        def f(x):
+            return object()
+
+        with patch("time.monotonic", return_value=100):
+            a = f(1)
+            assert a is f(1)
+        with patch("time.monotonic", return_value=111):
+            assert a is not f(1)
+
+    def test_cache_clear(self):
+        @memoize
+        def f(x):
+            return x
+
+        f(1)
+        f(1)
+        f.cache_clear()
+        assert (0, 0, 128, 0) == tuple(f.cache_info())
+
+    def test_thread_safety(self):
+        @memoize(maxsize=10)
+        def f(x):
+            return x * 2
+
+        def work():
+            for i in range(1000):
+                assert i % 20 * 2 == f(i % 20)
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = f.cache_info()
+        assert 8000 == info.hits + info.misses
+        assert 10 == info.currsize
@@ -1,9 +1,75 @@
+from http.client import IncompleteRead
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
 import unittest
 import mock
 import tempfile
 
+import km3db.core
 from km3db import DBManager
-from km3db.core import on_whitelisted_host, SESSION_COOKIES, AuthenticationError
+from km3db.core import (
+    on_whitelisted_host,
+    SESSION_COOKIES,
+    AuthenticationError,
+    ConnectionPool,
+    RetryPolicy,
+    get_db_manager,
+)
+from urllib.error import URLError
+
+from km3db.cache import ResponseCache
+
+
+class FakeDBHandler(BaseHTTPRequestHandler):
+    """Serves the requested path as body and counts the connections"""
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    requests = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_GET(self):
+        type(self).requests += 1
+        if "sleep" in self.path:
+            time.sleep(0.5)
+        body = self.path.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if "drop" in self.path:
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeDBServer:
+    def __init__(self, handler=FakeDBHandler):
+        self.handler = handler
+        self.handler.connections = 0
+        self.handler.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def fake_db_manager(url, **kwargs):
+    db = DBManager(url=url, **kwargs)
+    db._session_cookie = "_user_127.0.0.1_abc"
+    return db
 
 
 class TestKM3DB(unittest.TestCase):
@@ -121,3 +187,281 @@ class TestKM3DB(unittest.TestCase):
         )
 
         assert "namnam" == cookie
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeDBServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_connection_is_reused(self):
+        db = fake_db_manager(self.server.url)
+        for i in range(5):
+            assert "/streamds/{}".format(i) == db.get("streamds/{}".format(i))
+        assert 1 == self.server.handler.connections
+        assert 1 == len(db._pool)
+        db.close()
+        assert 0 == len(db._pool)
+
+    def test_reconnect_when_server_drops_connection(self):
+        db = fake_db_manager(self.server.url)
+        assert "/drop" == db.get("drop")
+        assert "/foo" == db.get("foo")
+        assert 2 == self.server.handler.connections
+
+    def test_idle_timeout(self):
+        db = fake_db_manager(self.server.url, idle_timeout=0)
+        db.get("foo")
+        db.get("bar")
+        assert 2 == self.server.handler.connections
+
+    def test_pool_size(self):
+        pool = ConnectionPool(maxsize=2)
+        conns = [mock.Mock() for _ in range(3)]
+        for conn in conns:
+            pool.release("key", conn)
+        assert 2 == len(pool)
+        conns[2].close.assert_called_once()
+        conn, reused = pool.acquire("key", mock.Mock)
+        assert reused
+        assert conn is conns[1]
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_exponential_backoff(self):
+        policy = RetryPolicy(delay=1, multiplier=2, max_delay=5, jitter=0)
+        delays = [policy.backoff(URLError("foo"), i, 0) for i in range(5)]
+        assert [1, 2, 4, 5, 5] == delays
+
+    def test_jitter(self):
+        policy = RetryPolicy(delay=10, jitter=0.1)
+        for _ in range(100):
+            assert 9 <= policy.backoff(URLError("foo"), 0, 0) <= 11
+
+    def test_retries(self):
+        policy = RetryPolicy(retries=2)
+        assert policy.backoff(URLError("foo"), 1, 0) is not None
+        assert policy.backoff(URLError("foo"), 2, 0) is None
+
+    def test_deadline(self):
+        policy = RetryPolicy(delay=1, jitter=0, deadline=10)
+        assert 1 == policy.backoff(URLError("foo"), 0, 8.5)
+        assert policy.backoff(URLError("foo"), 0, 9.5) is None
+
+    def test_rules(self):
+        policy = RetryPolicy(retries=5, rules={ConnectionError: 0, URLError: 1})
+        assert policy.backoff(ConnectionResetError(), 0, 0) is None
+        assert policy.backoff(URLError("foo"), 0, 0) is not None
+        assert policy.backoff(URLError("foo"), 1, 0) is None
+        assert policy.backoff(ValueError(), 4, 0) is not None
+
+    def test_replace(self):
+        policy = RetryPolicy.patient()
+        other = policy.replace(retries=1)
+        assert 1 == other.retries
+        assert policy.retries != other.retries
+        assert policy.deadline == other.deadline
+        with self.assertRaises(AttributeError):
+            policy.replace(foo=1)
+
+
+class TestDBManagerRetries(unittest.TestCase):
+    def setUp(self):
+        self.db = DBManager()
+        self.opener = mock.Mock()
+        self.db._opener = self.opener
+
+    @mock.patch("time.sleep")
+    def test_retries_until_success(self, sleep_mock):
+        response = mock.Mock()
+        response.read.return_value = b"foo"
+        self.opener.open.side_effect = [URLError("a"), URLError("b"), response]
+        assert "foo" == self.db.get("bar")
+        assert 3 == self.opener.open.call_count
+        assert 2 == sleep_mock.call_count
+
+    @mock.patch("time.sleep")
+    def test_gives_up(self, sleep_mock):
+        self.opener.open.side_effect = URLError("a")
+        self.db.retry_policy = RetryPolicy.fail_fast()
+        assert "default" == self.db.get("bar", default="default")
+        assert 3 == self.opener.open.call_count
+
+    @mock.patch("time.sleep")
+    def test_incomplete_reads_are_retried(self, sleep_mock):
+        truncated = mock.Mock()
+        truncated.read.side_effect = IncompleteRead(b"fo", 1)
+        response = mock.Mock()
+        response.read.return_value = b"foo"
+        self.opener.open.side_effect = [truncated, response]
+        assert "foo" == self.db.get("bar")
+        assert 2 == self.opener.open.call_count
+
+    @mock.patch("time.sleep")
+    def test_incomplete_reads_are_not_returned(self, sleep_mock):
+        truncated = mock.Mock()
+        truncated.read.side_effect = IncompleteRead(b"fo", 1)
+        self.opener.open.return_value = truncated
+        assert self.db.get("bar", retries=1) is None
+        assert 2 == self.opener.open.call_count
+
+    @mock.patch("time.sleep")
+    def test_retries_argument_overrides_policy(self, sleep_mock):
+        self.opener.open.side_effect = URLError("a")
+        assert self.db.get("bar", retries=0) is None
+        assert 1 == self.opener.open.call_count
+
+
+class TestTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeDBServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_read_timeout(self):
+        db = fake_db_manager(self.server.url, read_timeout=0.1)
+        assert db.get("sleep", retries=0) is None
+
+    def test_timeout_per_call(self):
+        db = fake_db_manager(self.server.url, read_timeout=0.1)
+        assert "/sleep" == db.get("sleep", timeout=(1, 2))
+
+    def test_deadline_in_the_past(self):
+        db = fake_db_manager(self.server.url)
+        assert "default" == db.get("foo", default="default", deadline=time.time() - 1)
+        assert 0 == self.server.handler.connections
+
+    def test_deadline_limits_retries(self):
+        db = fake_db_manager(self.server.url)
+        start = time.time()
+        assert db.get("sleep", deadline=time.time() + 0.2) is None
+        assert time.time() - start < 1
+
+
+class TestResponseCaching(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeDBServer()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_cached_responses(self):
+        cache = ResponseCache(path=self.tmpdir.name)
+        db = fake_db_manager(self.server.url, cache=cache)
+        assert "/foo?a=1&b=2" == db.get("foo?a=1&b=2")
+        assert "/foo?a=1&b=2" == db.get("foo?b=2&a=1")
+        assert b"/foo?a=1&b=2" == db.get("foo?a=1&b=2", binary=True)
+        assert 1 == cache.hits
+        assert 2 == cache.misses
+        db.close()
+        other_db = fake_db_manager(
+            self.server.url, cache=ResponseCache(self.tmpdir.name)
+        )
+        assert "/foo?a=1&b=2" == other_db.get("foo?a=1&b=2")
+        assert 1 == self.server.handler.connections
+
+    def test_cache_is_per_server(self):
+        cache = ResponseCache(path=self.tmpdir.name)
+        db = fake_db_manager(self.server.url, cache=cache)
+        assert "/foo" == db.get("foo")
+        other_server = FakeDBServer()
+        try:
+            other_db = fake_db_manager(other_server.url, cache=cache)
+            assert "/foo" == other_db.get("foo")
+            assert 1 == other_server.handler.connections
+            assert 0 == cache.hits
+        finally:
+            other_server.stop()
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeDBServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_open(self):
+        db = fake_db_manager(self.server.url)
+        with db.open("foo?a=1") as response:
+            assert b"/foo" == response.read(4)
+            assert b"?a=1" == response.read()
+        with db.open("bar") as response:
+            assert b"/bar" == response.read()
+        assert 1 == self.server.handler.connections
+        db.close()
+
+    def test_open_failure(self):
+        db = fake_db_manager("http://127.0.0.1:1", retry_policy=RetryPolicy(retries=0))
+        assert db.open("foo") is None
+
+
+class TestRequestCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeDBServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _concurrent_get(self, db, urls):
+        results = [None] * len(urls)
+
+        def get(idx):
+            results[idx] = db.get(urls[idx])
+
+        threads = [threading.Thread(target=get, args=(i,)) for i in range(len(urls))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_identical_requests_are_coalesced(self):
+        db = fake_db_manager(self.server.url)
+        urls = ["sleep?a=1&b=2", "sleep?b=2&a=1"] * 4
+        results = self._concurrent_get(db, urls)
+        assert 1 == self.server.handler.requests
+        assert len(set(results)) == 1
+        assert 0 == len(db._inflight)
+
+    def test_different_requests_are_not_coalesced(self):
+        db = fake_db_manager(self.server.url)
+        results = self._concurrent_get(db, ["sleep?a=1", "sleep?a=2"])
+        assert 2 == self.server.handler.requests
+        assert ["/sleep?a=1", "/sleep?a=2"] == results
+
+    def test_coalescing_can_be_disabled(self):
+        db = fake_db_manager(self.server.url, coalesce=False)
+        self._concurrent_get(db, ["sleep"] * 3)
+        assert 3 == self.server.handler.requests
+
+
+class TestDBManagerRegistry(unittest.TestCase):
+    def test_shared_instance(self):
+        db = get_db_manager()
+        assert db is get_db_manager()
+        assert db is get_db_manager(url="https://km3netdbweb.in2p3.fr")
+        assert db is not get_db_manager(network_class="B")
+        assert db is not get_db_manager(url="http://localhost")
+
+    @mock.patch("km3db.core.DBManager")
+    def test_patched_class_is_not_registered(self, db_manager_mock):
+        db = get_db_manager()
+        assert db is db_manager_mock.return_value
+
+    def test_registry_is_cleared_after_fork(self):
+        db = get_db_manager()
+        km3db.core._reset_db_managers()
+        assert db is not get_db_manager()
+
+    def test_pool_forgets_connections_after_fork(self):
+        pool = ConnectionPool()
+        pool.release("key", mock.Mock())
+        assert 1 == len(pool)
+        pool._pid = -1
+        assert 0 == len(pool)
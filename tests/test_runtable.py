@@ -0,0 +1,107 @@
+import io
+import os
+import tempfile
+import unittest
+from urllib.parse import parse_qs
+from mock import patch
+
+from km3db import StreamDS
+from km3db.cli.runtable import MAX_WINDOW, get_runs, runtable
+
+
+class TestRuntable(unittest.TestCase):
+    def setUp(self):
+        self.last_run = 10
+        self.missing = set()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        for patcher in (
+            patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir.name}),
+            patch("km3db.core.DBManager"),
+        ):
+            mock = patcher.start()
+            self.addCleanup(patcher.stop)
+        self.db = mock.return_value
+        self.db.get.side_effect = self._get
+
+    def _get(self, url, deadline=None):
+        if url.startswith("streamds/detectors"):
+            return "OID\tSERIALNUMBER\tLASTRUN\nD_ORCA006\t49\t{}\n".format(
+                self.last_run
+            )
+        selectors = {k: v[0] for k, v in parse_qs(url.partition("?")[2]).items()}
+        lines = ["RUN\tJOBTARGET\tRUNSETUPID\tRUNSETUPNAME\tT0_CALIBSETID"]
+        for run in range(1, self.last_run + 1):
+            target = "Run" if run % 2 else "Off"
+            if run in self.missing or str(run) != selectors.get("run", str(run)):
+                continue
+            if target != selectors.get("jobtarget", target):
+                continue
+            t0 = "" if run % 2 else "5"
+            lines.append("{0}\t{1}\tA0{0}\tsetup{0}\t{2}".format(run, target, t0))
+        return "\n".join(lines) + "\n"
+
+    def _runs_requests(self):
+        return [c[0][0] for c in self.db.get.call_args_list if "runs" in c[0][0]]
+
+    def _runtable(self, *args, **kwargs):
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            runtable(*args, **kwargs)
+        lines = stdout.getvalue().splitlines()
+        if lines:
+            assert "run\tjobtarget\trunsetupid\trunsetupname\tt0_calibsetid" == lines[0]
+        return [line.split("\t") for line in lines[1:]]
+
+    def test_last_runs_are_retrieved_one_by_one(self):
+        rows = self._runtable(49, n=3)
+        assert ["8", "9", "10"] == [row[0] for row in rows]
+        assert ["5", ""] == [row[4] for row in rows[:2]]
+        assert [
+            "streamds/runs.txt?detid=49&run=8",
+            "streamds/runs.txt?detid=49&run=9",
+            "streamds/runs.txt?detid=49&run=10",
+        ] == sorted(self._runs_requests(), key=len)
+        self.db.grow_pool.assert_called_once_with(4)
+
+    def test_gaps_fall_back_to_the_mirror(self):
+        self.missing = {9}
+        rows = self._runtable(49, n=3)
+        assert ["7", "8", "10"] == [row[0] for row in rows]
+        assert "streamds/runs.txt?detid=49" == self._runs_requests()[-1]
+
+    def test_job_target_is_passed_as_selector(self):
+        rows = self._runtable(49, n=None, run_range="2-6", target="run")
+        assert ["3", "5"] == [row[0] for row in rows]
+        requests = self._runs_requests()
+        assert 5 == len(requests)
+        assert all("&jobtarget=Run&" in url for url in requests)
+
+    def test_job_target_without_window_uses_the_mirror(self):
+        rows = self._runtable(49, n=2, target="off")
+        assert ["8", "10"] == [row[0] for row in rows]
+        assert ["streamds/runs.txt?detid=49"] == self._runs_requests()
+
+    def test_refresh(self):
+        self._runtable(49, n=2, target="off")
+        self._runtable(49, n=2, target="off")
+        assert 1 == len(self._runs_requests())
+        rows = self._runtable(49, n=2, target="off", refresh=True)
+        assert ["8", "10"] == [row[0] for row in rows]
+        assert ["streamds/runs.txt?detid=49"] * 2 == self._runs_requests()
+
+    def test_max_window(self):
+        self.last_run = MAX_WINDOW + 1
+        rows = self._runtable(49, n=None, run_range="1-{}".format(MAX_WINDOW))
+        assert MAX_WINDOW == len(rows)
+        assert MAX_WINDOW == len(self._runs_requests())
+        self.db.get.reset_mock()
+        rows = self._runtable(49, n=None, run_range="1-{}".format(MAX_WINDOW + 1))
+        assert MAX_WINDOW + 1 == len(rows)
+        assert ["streamds/runs.txt?detid=49"] == self._runs_requests()
+
+    def test_both_paths_return_the_same_rows(self):
+        runs = get_runs(49, range(1, self.last_run + 1))
+        mirrored = StreamDS(container="records", runs_mirror=True).get("runs", detid=49)
+        assert runs == mirrored
+        assert type(runs[0]) is type(mirrored[0])
+        assert ["", 5] == [r.t0_calibsetid for r in runs[:2]]
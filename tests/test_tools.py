@@ -1,12 +1,34 @@
 #!/usr/bin/env python3
 
+from collections import namedtuple
+import importlib.util
+import inspect
+import io
+import json
+import os
+import pickle
+import tempfile
+import time
 import unittest
 from mock import patch
 
-from km3db import StreamDS, CLBMap
+import numpy as np
+
+from km3db import StreamDS, CLBMap, DBManager, jsoncodec
+from km3db.cache import MirrorCache, ResultCache, SchemaCache
 from km3db.tools import (
+    APIv2,
+    _apiv2,
+    _extract_schema,
+    _streamds,
+    tocolumns,
+    tonumpy_columns,
+    JSONDS,
     clbupi2compassupi,
     tonamedtuples,
+    tonumpy,
+    toarrow,
+    RunsMirror,
     show_compass_calibration,
     detx,
     detx_for_run,
@@ -64,6 +86,18 @@ class TestStreamDSOffline(unittest.TestCase):
         db_manager_mock_obj.get.return_value = streamds_meta
         self.sds = StreamDS()
 
+    @patch("km3db.core.get_db_manager")
+    def test_custom_db_manager(self, get_db_manager_mock):
+        db = DBManager(url="https://db.example.org")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                with patch.object(db, "get", return_value="A\tB\n1\t2\n") as get:
+                    sds = StreamDS(db=db, container="nt", schema_cache=False)
+                    assert [(1, 2)] == sds.get("runs", detid=49)
+        get_db_manager_mock.assert_not_called()
+        get.assert_called_once_with("streamds/runs.txt?detid=49", deadline=None)
+        assert "https://db.example.org" == sds._db_url
+
     def test_streams(self):
         assert len(self.sds.streams) == 30
         assert "ahrs" in self.sds.streams
@@ -105,6 +139,946 @@ class TestStreamDSOffline(unittest.TestCase):
     def test_print_streams(self):
         self.sds.print_streams()
 
+    @patch("km3db.core.DBManager")
+    def test_db_manager_is_shared(self, db_manager_mock):
+        db_manager_mock.return_value.get.return_value = self.sds._db.get.return_value
+        sds = StreamDS()
+        assert sds._db is db_manager_mock.return_value
+        assert sds._db is JSONDS()._db
+
+    def test_deadline_is_passed_to_db(self):
+        self.sds.get("runs", detid=49, deadline=123)
+        self.sds._db.get.assert_called_with("streamds/runs.txt?detid=49", deadline=123)
+
+    @patch("km3db.core.DBManager")
+    def test_catalog_is_loaded_lazily(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.return_value = self.sds._db.get.return_value
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                sds = StreamDS()
+                db.get.assert_not_called()
+                assert "runs" in sds.streams
+                db.get.assert_called_once_with("streamds")
+                assert sds.runs is sds.runs
+
+    @patch("km3db.core.DBManager")
+    def test_catalog_is_retried_after_a_failure(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        streamds_meta = self.sds._db.get.return_value
+        db.get.return_value = None
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                sds = StreamDS()
+                assert 0 == len(sds.streams)
+                db.get.return_value = "ERROR: foo"
+                assert 0 == len(sds.streams)
+                db.get.return_value = streamds_meta
+                assert 30 == len(sds.streams)
+                assert 3 == db.get.call_count
+
+    @patch("km3db.core.DBManager")
+    def test_catalog_is_cached_on_disk(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.return_value = self.sds._db.get.return_value
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                assert 30 == len(StreamDS().streams)
+                assert 30 == len(StreamDS().streams)
+                assert 1 == db.get.call_count
+                sds = StreamDS()
+                sds._update_streams(refresh=True)
+                assert 2 == db.get.call_count
+
+    def test_iter(self):
+        with open(data_path("db/clbmap.txt"), "rb") as fobj:
+            content = fobj.read()
+        self.sds._db.open.return_value = io.BytesIO(content)
+        rows = list(self.sds.iter("clbmap", detoid="D_ORCA003", chunk_size=100))
+        self.sds._db.open.assert_called_with(
+            "streamds/clbmap.txt?detoid=D_ORCA003", deadline=None
+        )
+        assert tonamedtuples("Clbmap", content.decode()) == rows
+
+    def test_iter_batches(self):
+        with open(data_path("db/clbmap.txt"), "rb") as fobj:
+            content = fobj.read()
+        self.sds._db.open.return_value = io.BytesIO(content)
+        batches = list(self.sds.iter("clbmap", batch_size=20))
+        assert [20, 20, 17] == [len(b) for b in batches]
+        assert tonumpy(content.decode()).tolist() == sum(
+            (b.tolist() for b in batches), []
+        )
+
+    def test_iter_decodes_incrementally(self):
+        content = "NAME\tVALUE\nCréteil\t1\nSète\t2.5\n".encode()
+        self.sds._db.open.return_value = io.BytesIO(content)
+        rows = list(self.sds.iter("foo", chunk_size=1))
+        assert [("Créteil", 1), ("Sète", 2.5)] == rows
+
+    def test_iter_error(self):
+        self.sds._db.open.return_value = io.BytesIO(b"ERROR: foo\n")
+        assert [] == list(self.sds.iter("foo"))
+        self.sds._db.open.return_value = None
+        assert [] == list(self.sds.iter("foo"))
+
+    def test_run_ranges_are_split(self):
+        def get(url, deadline=None):
+            selectors = dict(p.split("=") for p in url.split("?")[1].split("&"))
+            minrun, maxrun = int(selectors["minrun"]), int(selectors["maxrun"])
+            return "RUN\tVALUE\n" + "".join(
+                "{}\t{}\n".format(run, run * 0.5) for run in range(minrun, maxrun + 1)
+            )
+
+        self.sds._db.get.side_effect = get
+        self.sds.runs_per_request = 3
+        text = self.sds.get("runsummarynumbers", detid=49, minrun=1, maxrun=10)
+        assert get("?minrun=1&maxrun=10") == text
+        urls = sorted(c[0][0] for c in self.sds._db.get.call_args_list)
+        assert 4 == len(urls)
+        assert "streamds/runsummarynumbers.txt?detid=49&minrun=10&maxrun=10" in urls
+        self.sds._db.grow_pool.assert_called_once_with(4)
+        runs = self.sds.get("runsummarynumbers", container="nt", minrun=2, maxrun=8)
+        assert list(range(2, 9)) == [r.run for r in runs]
+        runs = self.sds.get("runsummarynumbers", container="np", minrun=2, maxrun=8)
+        assert list(range(2, 9)) == runs["run"].tolist()
+
+    def test_failed_chunks_invalidate_the_result(self):
+        self.sds._db.get.side_effect = lambda url, deadline=None: (
+            None if "minrun=4" in url else "RUN\n1\n"
+        )
+        self.sds.runs_per_request = 3
+        assert self.sds.get("runsummarynumbers", minrun=1, maxrun=10) is None
+
+    def test_small_ranges_are_not_split(self):
+        self.sds.get("runsummarynumbers", detid=49, minrun=1, maxrun=1000)
+        self.sds._db.get.assert_called_once_with(
+            "streamds/runsummarynumbers.txt?detid=49&minrun=1&maxrun=1000",
+            deadline=None,
+        )
+
+    def test_time_ranges_are_split(self):
+        self.sds._db.get.side_effect = lambda url, deadline=None: "A\n" + url + "\n"
+        self.sds.seconds_per_request = 10
+        text = self.sds.get("jobs", unixmintime=100, unixmaxtime=119)
+        assert (
+            "A\nstreamds/jobs.txt?unixmintime=100&unixmaxtime=109\n"
+            "streamds/jobs.txt?unixmintime=110&unixmaxtime=119\n"
+        ) == text
+
+    def test_result_cache(self):
+        def get(url, deadline=None):
+            if url.startswith("streamds/detectors"):
+                return "OID\tSERIALNUMBER\tLASTRUN\nD_ORCA006\t49\t100\n"
+            return "RUN\tVALUE\n1\t2.5\n"
+
+        self.sds._db.get.side_effect = get
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.sds.result_cache = ResultCache(path=tmpdir, open_ttl=10)
+            closed = dict(detid=49, minrun=1, maxrun=99)
+            open_ = dict(detid="D_ORCA006", minrun=1, maxrun=100)
+            for selectors in (closed, open_):
+                runs = self.sds.get("runsummarynumbers", container="np", **selectors)
+                assert [1] == runs["run"].tolist()
+            n_requests = self.sds._db.get.call_count
+            runs = self.sds.get("runsummarynumbers", container="nt", **closed)
+            assert 2.5 == runs[0].value
+            df = self.sds.get("runsummarynumbers", container="pd", **open_)
+            assert ["RUN", "VALUE"] == list(df.columns)
+            assert n_requests == self.sds._db.get.call_count
+            with patch("time.time", return_value=time.time() + 11):
+                self.sds.get("runsummarynumbers", container="np", **closed)
+                assert n_requests == self.sds._db.get.call_count
+                self.sds.get("runsummarynumbers", container="np", **open_)
+                assert n_requests < self.sds._db.get.call_count
+
+    def test_cached_results_match_the_uncached_ones(self):
+        self.sds._db.get.return_value = (
+            "RUN\tPROMISID\tT0_CALIBSETID\n1\t0123\t\n2\t0456\t5\n"
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for container in ("nt", "pd", "np"):
+                self.sds.result_cache = None
+                expected = self.sds.get("runs", container=container, detid=49)
+                self.sds.result_cache = ResultCache(path=tmpdir)
+                for _ in range(2):
+                    result = self.sds.get("runs", container=container, detid=49)
+                    if container == "pd":
+                        assert expected.dtypes.tolist() == result.dtypes.tolist()
+                        assert expected.equals(result)
+                    elif container == "np":
+                        assert expected.dtype == result.dtype
+                        assert repr(expected.tolist()) == repr(result.tolist())
+                    else:
+                        assert expected == result
+                        assert [""] == [r.t0_calibsetid for r in result[:1]]
+                assert 1 == len(self.sds.result_cache)
+
+    def test_raw_output_is_not_cached(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.sds.result_cache = ResultCache(path=tmpdir)
+            self.sds.get("detectors")
+            self.sds.get("detectors")
+            assert 0 == len(self.sds.result_cache)
+
+    def test_private_attributes_are_not_streams(self):
+        with self.assertRaises(AttributeError):
+            self.sds._foo
+
+    def test_multi_valued_selectors(self):
+        def get(url, deadline=None):
+            if "detid=3" in url:
+                return "ERROR: unknown detector"
+            return "RUN\tURL\n1\t{}\n".format(url)
+
+        self.sds._db.get.side_effect = get
+        runs = self.sds.get("runs", container="nt", detid=[1, 2], minrun=range(5, 7))
+        assert [(1, 5), (1, 6), (2, 5), (2, 6)] == [(r.detid, r.minrun) for r in runs]
+        assert "streamds/runs.txt?detid=2&minrun=5" == runs[2].url
+        text = self.sds.get("runs", detid=(1, 3))
+        assert "DETID\tRUN\tURL\n1\t1\tstreamds/runs.txt?detid=1\n" == text
+        assert self.sds.get("runs", detid=[3]) is None
+        assert self.sds.get("runs", container="nt", detid=[]) is None
+
+    def test_multi_valued_selectors_are_not_tagged_twice(self):
+        self.sds._db.get.side_effect = lambda url, deadline=None: (
+            "RUN\n" + url[-1] + "\n"
+        )
+        arr = self.sds.get("runs", container="np", run=[1, 2])
+        assert ("run",) == arr.dtype.names
+        assert [1, 2] == arr["run"].tolist()
+
+    def test_multi_valued_selectors_with_ranges(self):
+        self.sds.runs_per_request = 10
+        self.sds._db.get.side_effect = lambda url, deadline=None: "A\n" + url + "\n"
+        text = self.sds.get("runs", detid=["x", "y"], minrun=1, maxrun=15)
+        assert [
+            "DETID\tA",
+            "x\tstreamds/runs.txt?detid=x&minrun=1&maxrun=10",
+            "x\tstreamds/runs.txt?detid=x&minrun=11&maxrun=15",
+            "y\tstreamds/runs.txt?detid=y&minrun=1&maxrun=10",
+            "y\tstreamds/runs.txt?detid=y&minrun=11&maxrun=15",
+        ] == text.split("\n")[:-1]
+
+    @patch("km3db.core.DBManager")
+    def test_pandas_schema_is_learned(self, db_manager_mock):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.sds.schema_cache = SchemaCache(tmpdir)
+            self.sds._db.get.return_value = "RUN\tTYPE\tV\n1\ta\t1\n2\ta\t2\n"
+            df = self.sds.get("runs", container="pd", detid=49)
+            assert "category" == df["TYPE"].dtype
+            assert np.int64 == df["V"].dtype
+            assert 1 == len(self.sds.schema_cache)
+            # the same dtypes, although pandas would infer others
+            sds = StreamDS(schema_cache=SchemaCache(tmpdir))
+            sds._db.get.return_value = "RUN\tTYPE\tV\n3\t1\t1.5\n"
+            df = sds.get("runs", container="pd", detid=49, columns=["type"])
+            assert ["TYPE"] == list(df.columns)
+            assert "category" == df["TYPE"].dtype
+            assert ["1"] == df["TYPE"].tolist()
+
+    def test_pandas_schema_gives_the_same_result_on_each_call(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.sds.schema_cache = SchemaCache(tmpdir)
+            self.sds._db.get.return_value = (
+                "RUN\tNAME\tV\n1\t\t\n2\tb\t2\n3\tc\t3\n"
+            )
+            first = self.sds.get("runs", container="pd", detid=49)
+            second = self.sds.get("runs", container="pd", detid=49)
+            assert first.dtypes.tolist() == second.dtypes.tolist()
+            assert first.equals(second)
+            assert first["NAME"].isna().tolist() == [True, False, False]
+
+    def test_pandas_schema_fallback(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.sds.schema_cache = SchemaCache(tmpdir)
+            self.sds._db.get.return_value = "RUN\tV\n1\t1\n2\t2\n"
+            self.sds.get("runs", container="pd", detid=49)
+            self.sds._db.get.return_value = "RUN\tV\n1\t\n2\t2\n"
+            df = self.sds.get("runs", container="pd", detid=49)
+            assert np.float64 == df["V"].dtype
+            self.sds._db.get.return_value = "RUN\tW\n1\tx\n2\ty\n"
+            df = self.sds.get("runs", container="pd", detid=49)
+            assert ["RUN", "W"] == list(df.columns)
+            assert ["x", "y"] == df["W"].tolist()
+
+    def test_columns(self):
+        self.sds._db.get.return_value = "RUN\tNAME\tVALUE\n1\tfoo\t0.5\n2\tbar\t1.5\n"
+        selected = ["value", "RUN"]
+        arr = self.sds.get("runs", container="np", detid=49, columns=selected)
+        assert ("value", "run") == arr.dtype.names
+        runs = self.sds.get("runs", container="nt", detid=49, columns=selected)
+        assert [(0.5, 1), (1.5, 2)] == [tuple(r) for r in runs]
+        df = self.sds.get("runs", container="pd", detid=49, columns=selected)
+        assert ["VALUE", "RUN"] == list(df.columns)
+        text = self.sds.get("runs", detid=49, columns=selected)
+        assert "VALUE\tRUN\n0.5\t1\n1.5\t2\n" == text
+        runs = self.sds.runs(detid=49, container="nt", columns=["name"])
+        assert ["foo", "bar"] == [r.name for r in runs]
+        assert "columns" in str(inspect.signature(self.sds.runs))
+
+    def test_unknown_columns(self):
+        self.sds._db.get.return_value = "RUN\tNAME\n1\tfoo\n"
+        assert self.sds.get("runs", container="nt", detid=49, columns=["x"]) is None
+
+    def test_columns_with_result_cache(self):
+        self.sds._db.get.return_value = "RUN\tNAME\tVALUE\n1\tfoo\t0.5\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.sds.result_cache = ResultCache(path=tmpdir)
+            self.sds.get("runs", container="np", detid=49)
+            df = self.sds.get("runs", container="pd", detid=49, columns=["name"])
+            assert ["NAME"] == list(df.columns)
+            runs = self.sds.get("runs", container="nt", detid=49, columns=["value"])
+            assert [0.5] == [r.value for r in runs]
+            assert 1 == len(self.sds.result_cache)
+
+
+class TestToNamedtuples(unittest.TestCase):
+    text = "RUN\tNAME\tVALUE\tMIXED\n1\tfoo\t0.5\t\n2\tbar\t1.5\t3\n3\tfoo\t2\tx\n"
+
+    def test_list_of_namedtuples(self):
+        runs = tonamedtuples("Runs", self.text)
+        assert isinstance(runs, list)
+        assert all(isinstance(r, tuple) for r in runs)
+        assert ("run", "name", "value", "mixed") == runs[0]._fields
+        assert [1, 2, 3] == [r.run for r in runs]
+        assert ["", 3, "x"] == [r.mixed for r in runs]
+        assert 6 == len(runs + runs)
+        assert 4 == runs[0]._replace(run=4).run
+        assert [[1, "foo", 0.5, ""]] == json.loads(json.dumps(runs[:1]))
+        assert type(runs[0]) is type(tonamedtuples("Runs", self.text)[0])
+        assert [] == tonamedtuples("Runs", "RUN\tNAME\n")
+
+    def test_mixed_numbers_are_kept(self):
+        text = "RUN\tT0\n1\t5\n2\t5.0\n3\t\n4\t0\n5\t-0.0\n6\t\u0661\n"
+        for compact in (False, True):
+            runs = tonamedtuples("R", text, compact=compact)
+            values = [r.t0 for r in runs]
+            assert [5, 5.0, "", 0, -0.0, 1] == values
+            assert [int, float, str, int, float, int] == [type(v) for v in values]
+
+    def test_attribute_access(self):
+        runs = tonamedtuples("Runs", self.text, compact=True)
+        assert 3 == len(runs)
+        assert ("run", "name", "value", "mixed") == runs[0]._fields
+        assert [1, 2, 3] == [r.run for r in runs]
+        assert "bar" == runs[1].name
+        assert 2 == runs[-1].value
+        assert ["", 3, "x"] == [r.mixed for r in runs]
+        assert "Runs(run=1, name='foo', value=0.5, mixed='')" == repr(runs[0])
+        with self.assertRaises(IndexError):
+            runs[3]
+
+    def test_behaves_like_namedtuples(self):
+        runs = tonamedtuples("Runs", self.text, compact=True)
+        Runs = namedtuple("Runs", runs[0]._fields)
+        expected = [
+            Runs(1, "foo", 0.5, ""),
+            Runs(2, "bar", 1.5, 3),
+            Runs(3, "foo", 2, "x"),
+        ]
+        assert expected == runs
+        assert runs == expected
+        assert expected[1:] == runs[1:]
+        assert (1, "foo", 0.5, "") == tuple(runs[0])
+        assert {runs[0]: 1}[expected[0]] == 1
+        assert sorted(runs, reverse=True) == expected[::-1]
+        assert expected[0]._asdict() == runs[0]._asdict()
+
+    def test_record_classes_are_cached(self):
+        a = tonamedtuples("Runs", self.text, compact=True)
+        b = tonamedtuples("Runs", self.text, compact=True)
+        assert type(a[0]) is type(b[0])
+        c = tonamedtuples("Other", self.text, compact=True)
+        assert type(a[0]) is not type(c[0])
+
+    def test_pickle(self):
+        runs = tonamedtuples("Runs", self.text, compact=True)
+        assert runs == pickle.loads(pickle.dumps(runs))
+
+    def test_inconsistent_columns(self):
+        with self.assertRaises(ValueError):
+            tonamedtuples("Foo", "A\tB\n1\t2\n3\n")
+
+    def test_columns(self):
+        runs = tonamedtuples("Runs", self.text, columns=["name", "RUN"])
+        assert ("name", "run") == runs[0]._fields
+        assert [("foo", 1), ("bar", 2), ("foo", 3)] == [tuple(r) for r in runs]
+        runs = tonamedtuples("Runs", self.text, renamemap={"RUN": "x"}, columns=["x"])
+        assert [1, 2, 3] == [r.x for r in runs]
+        with self.assertRaises(ValueError):
+            tonamedtuples("Runs", self.text, columns=["foo"])
+
+
+class TestToNumpy(unittest.TestCase):
+    def test_clbmap(self):
+        with open(data_path("db/clbmap.txt"), "r") as fobj:
+            text = fobj.read()
+        arr = tonumpy(text, renamemap=CLBMap.renamemap)
+        nts = tonamedtuples("CLB", text, renamemap=CLBMap.renamemap)
+        assert 57 == len(arr)
+        assert nts[0]._fields == arr.dtype.names
+        assert np.int64 == arr.dtype["dom_id"]
+        assert object == arr.dtype["upi"]
+        for nt, row in zip(nts, arr):
+            assert nt == tuple(row.tolist())
+
+    def test_type_inference(self):
+        text = "A\tB\tC\tD\tPROMISID\n1\t1.5\tfoo\t\t0021AB\n2\t\t3\t4\t0052\n"
+        arr = tonumpy(text)
+        assert ("a", "b", "c", "d", "promisid") == arr.dtype.names
+        assert np.int64 == arr.dtype["a"]
+        assert np.float64 == arr.dtype["b"]
+        assert np.isnan(arr["b"][1])
+        assert object == arr.dtype["c"]
+        assert ["foo", "3"] == arr["c"].tolist()
+        assert np.float64 == arr.dtype["d"]
+        assert ["0021AB", "0052"] == arr["promisid"].tolist()
+
+    def test_equal_strings_are_shared(self):
+        arr = tonumpy("A\tB\n1\tfoo\n2\tfoo\n3\tbar\n")
+        assert arr["b"][0] is arr["b"][1]
+        assert ["foo", "foo", "bar"] == arr["b"].tolist()
+
+    def test_header_only(self):
+        arr = tonumpy("A\tB\n")
+        assert 0 == len(arr)
+        assert ("a", "b") == arr.dtype.names
+
+    def test_inconsistent_columns(self):
+        with self.assertRaises(ValueError):
+            tonumpy("A\tB\n1\t2\n3\n")
+
+    def test_columns(self):
+        text = "A\tB\tC\n1\t1.5\tfoo\n2\t2.5\tbar\n"
+        arr = tonumpy(text, columns=["b"])
+        assert ("b",) == arr.dtype.names
+        assert [1.5, 2.5] == arr["b"].tolist()
+        arr = tonumpy(text, columns=["C", "a"])
+        assert [("foo", 1), ("bar", 2)] == arr.tolist()
+        with self.assertRaises(ValueError):
+            tonumpy(text, columns=["d"])
+
+
+class TestRunsMirror(unittest.TestCase):
+    @patch("km3db.core.DBManager")
+    def setUp(self, db_manager_mock):
+        self.last_run = 5
+        self.extra_column = False
+        self.setup_suffix = ""
+        self.db = db_manager_mock.return_value
+        self.db.get.side_effect = self._get
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sds = StreamDS(container="nt")
+        self.mirror = RunsMirror(
+            self.sds, cache=MirrorCache(self.tmpdir.name), max_age=0, max_delta=3
+        )
+        self.sds.runs_mirror = self.mirror
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _get(self, url, deadline=None):
+        if url.startswith("streamds/detectors"):
+            return "OID\tSERIALNUMBER\tLASTRUN\nD_ORCA006\t49\t{}\n".format(
+                self.last_run
+            )
+        if "run=" in url:
+            runs = [int(url.split("run=")[1])]
+        else:
+            runs = range(1, self.last_run + 1)
+        extra = "\t{}" if self.extra_column else ""
+        return "RUN\tRUNSETUPNAME{}\n".format(extra.format("X")) + "".join(
+            "{}\tsetup{}{}{}\n".format(run, run, self.setup_suffix, extra.format(0))
+            for run in runs
+            if run <= self.last_run
+        )
+
+    def _runs_requests(self):
+        return [c[0][0] for c in self.db.get.call_args_list if "runs" in c[0][0]]
+
+    def test_initial_sync(self):
+        runs = self.sds.get("runs", detid=49)
+        assert [1, 2, 3, 4, 5] == [r.run for r in runs]
+        assert "setup3" == runs[2].runsetupname
+        assert ["streamds/runs.txt?detid=49"] == self._runs_requests()
+
+    def test_delta_sync(self):
+        self.sds.get("runs", detid=49)
+        self.last_run = 7
+        runs = self.sds.get("runs", detid=49, container="np")
+        assert list(range(1, 8)) == runs["run"].tolist()
+        assert [
+            "streamds/runs.txt?detid=49",
+            "streamds/runs.txt?detid=49&run=5",
+            "streamds/runs.txt?detid=49&run=6",
+            "streamds/runs.txt?detid=49&run=7",
+        ] == sorted(self._runs_requests())
+        self.sds._db.grow_pool.assert_called_once_with(3)
+        self.sds.get("runs", detid=49)
+        assert 5 == len(self._runs_requests())
+
+    def test_last_stored_run_is_updated(self):
+        self.sds.get("runs", detid=49)
+        self.setup_suffix = "b"
+        runs = self.sds.get("runs", detid=49)
+        assert ["setup4", "setup5b"] == [r.runsetupname for r in runs[-2:]]
+        assert list(range(1, 6)) == [r.run for r in runs]
+
+    def test_refresh(self):
+        self.sds.get("runs", detid=49)
+        self.setup_suffix = "b"
+        self.mirror.sync(49, refresh=True)
+        runs = self.sds.get("runs", detid=49)
+        assert all(r.runsetupname.endswith("b") for r in runs)
+        assert ["streamds/runs.txt?detid=49"] * 2 == self._runs_requests()[:2]
+
+    def test_large_delta_fetches_everything(self):
+        self.sds.get("runs", detid=49)
+        self.last_run = 10
+        assert 10 == len(self.sds.get("runs", detid=49))
+        assert ["streamds/runs.txt?detid=49"] * 2 == self._runs_requests()
+
+    def test_changed_header_fetches_everything(self):
+        self.sds.get("runs", detid=49)
+        self.last_run = 6
+        self.extra_column = True
+        runs = self.sds.get("runs", detid=49)
+        assert list(range(1, 7)) == [r.run for r in runs]
+        assert ("run", "runsetupname", "x") == runs[0]._fields
+        assert "streamds/runs.txt?detid=49" == self._runs_requests()[-1]
+
+    def test_single_run(self):
+        runs = self.sds.get("runs", detid=49, run=3)
+        assert [3] == [r.run for r in runs]
+        assert [] == self.sds.get("runs", detid=49, run=42)
+
+    def test_results_match_the_stream(self):
+        def get(url, deadline=None):
+            if url.startswith("streamds/detectors"):
+                return self._get(url)
+            lines = ["RUN\tPROMISID\tT0_CALIBSETID", "1\t0123\t", "2\t0456\t5"]
+            if "run=" in url:
+                run = url.split("run=")[1]
+                lines = lines[:1] + [l for l in lines[1:] if l.split("\t")[0] == run]
+            return "\n".join(lines) + "\n"
+
+        self.db.get.side_effect = get
+        for container in ("nt", "pd"):
+            self.sds.runs_mirror = None
+            expected = self.sds.get("runs", detid=49, container=container)
+            self.sds.runs_mirror = self.mirror
+            runs = self.sds.get("runs", detid=49, container=container)
+            if container == "pd":
+                assert expected.dtypes.tolist() == runs.dtypes.tolist()
+                assert expected.equals(runs)
+            else:
+                assert expected == runs
+                assert ["", 5] == [r.t0_calibsetid for r in runs]
+
+    def test_deadline(self):
+        self.sds.get("runs", detid=49, deadline=123)
+        self.last_run = 6
+        self.sds.get("runs", detid=49, deadline=456)
+        deadlines = [c[1].get("deadline") for c in self.db.get.call_args_list]
+        assert [123, 456, 456, 456] == deadlines
+
+    def test_max_age(self):
+        self.mirror.max_age = 60
+        self.sds.get("runs", detid=49)
+        n_requests = self.db.get.call_count
+        self.last_run = 7
+        assert 5 == len(self.sds.get("runs", detid=49))
+        assert n_requests == self.db.get.call_count
+
+    def test_raw_output_is_not_mirrored(self):
+        assert self.sds.get("runs", detid=49)
+        self.sds._default_container = None
+        text = self.sds.get("runs", detid=49)
+        assert text.startswith("RUN\tRUNSETUPNAME")
+        assert 2 == len(self._runs_requests())
+
+
+@unittest.skipIf(importlib.util.find_spec("pyarrow") is None, "requires pyarrow")
+class TestToArrow(unittest.TestCase):
+    def test_clbmap(self):
+        with open(data_path("db/clbmap.txt"), "rb") as fobj:
+            content = fobj.read()
+        table = toarrow(content)
+        assert 57 == table.num_rows
+        assert tonumpy(content.decode()).tolist() == [
+            tuple(row.values()) for row in table.to_pylist()
+        ]
+        assert table.equals(toarrow(content.decode()))
+
+    def test_type_inference(self):
+        table = toarrow("A\tB\tPROMISID\n1\t\t0021AB\n2\t1.5\t0052\n")
+        assert ["A", "B", "PROMISID"] == table.column_names
+        assert "int64" == str(table.schema.field("A").type)
+        assert [None, 1.5] == table.column("B").to_pylist()
+        assert ["0021AB", "0052"] == table.column("PROMISID").to_pylist()
+
+    def test_columns(self):
+        table = toarrow("A\tB\tC\n1\t2\t3\n", columns=["c", "A"])
+        assert ["C", "A"] == table.column_names
+
+    @patch("km3db.core.DBManager")
+    def test_container_parses_the_undecoded_response(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.return_value = b"RUN\tNAME\n1\t\xc3\xbc\n2\tb\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                table = StreamDS(container="arrow").get("runs", detid=49)
+        db.get.assert_called_once_with(
+            "streamds/runs.txt?detid=49", binary=True, deadline=None
+        )
+        assert ["ü", "b"] == table.column("NAME").to_pylist()
+
+    @patch("km3db.core.DBManager")
+    def test_cli_output(self, db_manager_mock):
+        import pyarrow.feather
+        import pyarrow.parquet
+        from km3db.cli.streamds import get_data
+
+        with open(data_path("db/streamds_output.txt"), "r") as fobj:
+            streamds_meta = fobj.read()
+        with open(data_path("db/clbmap.txt"), "rb") as fobj:
+            content = fobj.read()
+
+        def get(url, binary=False, deadline=None):
+            if url == "streamds":
+                return streamds_meta
+            return content if binary else content.decode()
+
+        db_manager_mock.return_value.get.side_effect = get
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                for ext, read in (
+                    (".parquet", pyarrow.parquet.read_table),
+                    (".feather", pyarrow.feather.read_table),
+                ):
+                    outfile = os.path.join(tmpdir, "clbmap" + ext)
+                    with patch("sys.stdout", new_callable=io.StringIO):
+                        with self.assertRaises(SystemExit):
+                            get_data("clbmap", ["detoid=D_ORCA003"], "txt", outfile)
+                    assert read(outfile).equals(toarrow(content))
+
+
+class TestAPIv2Offline(unittest.TestCase):
+    catalog = json.dumps(
+        {
+            "Error": {"Code": "OK"},
+            "Data": [
+                {
+                    "Name": "RunCalibration",
+                    "Description": "Calibrations of a run",
+                    "Selectors": ["DetOId -> Detector", "Run -> Run number"],
+                    "Schema": ["Run -> Integer", "Type -> String"],
+                }
+            ],
+        }
+    )
+
+    def get(self, url, binary=False, deadline=None):
+        if url == "apiv2.1.0/":
+            content = self.catalog
+        else:
+            content = json.dumps({"Error": {"Code": "OK"}, "Data": [url]})
+        return content.encode() if binary else content
+
+    @patch("km3db.core.DBManager")
+    def test_catalog_is_loaded_lazily_and_cached(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.side_effect = self.get
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                api = APIv2()
+                db.get.assert_not_called()
+                assert ["RunCalibration"] == list(api.endpoints)
+                assert api.endpoints is api.endpoints
+                assert ["RunCalibration"] == list(APIv2().endpoints)
+                assert 1 == db.get.call_count
+                APIv2()._update_endpoints(refresh=True)
+                assert 2 == db.get.call_count
+
+    @patch("km3db.core.DBManager")
+    def test_catalog_is_retried_after_a_failure(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.return_value = None
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                api = APIv2()
+                with self.assertRaises(AttributeError):
+                    api.RunCalibration
+                db.get.side_effect = self.get
+                assert callable(api.RunCalibration)
+
+    @patch("km3db.core.DBManager")
+    def test_detx_for_run_passes_the_deadline(self, db_manager_mock):
+        deadlines = []
+
+        def get(url, binary=False, deadline=None):
+            deadlines.append(deadline)
+            if url.startswith("streamds/detectors"):
+                return "OID\tSERIALNUMBER\nD_ORCA006\t49\n"
+            if url.startswith("detx/"):
+                return url
+            if url == "apiv2.1.0/":
+                return self.catalog.encode()
+            data = [{"CalibrationType": "PMT_T0_CALIBRATION", "CalibrationId": 7}]
+            return json.dumps({"Error": {"Code": "OK"}, "Data": data}).encode()
+
+        db_manager_mock.return_value.get.side_effect = get
+        memoized = (_apiv2, _streamds, todetoid)
+        for func in memoized:
+            func.cache_clear()
+            self.addCleanup(func.cache_clear)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                detx = detx_for_run(49, 10, deadline=123)
+        assert "tcal=7" in detx
+        assert 4 == len(deadlines)
+        assert {123} == set(deadlines)
+
+    @patch("km3db.core.get_db_manager")
+    def test_custom_db_manager(self, get_db_manager_mock):
+        db = DBManager(url="https://db.example.org")
+        with patch.object(db, "get", side_effect=self.get) as get:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with patch.dict(os.environ, {"KM3DB_CACHE_DIR": tmpdir}):
+                    api = APIv2(db=db)
+                    data = api.RunCalibration(Run=1)
+            assert ["apiv2.1.0/RunCalibration/s?&Run=1"] == data
+            assert "https://db.example.org" == api._db_url
+            detx(49, tcal=7, db=db)
+            get.assert_called_with(
+                "detx/49?tcal=7&pcal=0&rcal=0&acal=0&ccal=0&scal=0&v=5", deadline=None
+            )
+        get_db_manager_mock.assert_not_called()
+
+    @patch("km3db.core.DBManager")
+    def test_endpoint_functions(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.side_effect = self.get
+        api = APIv2()
+        assert api.RunCalibration is api.RunCalibration
+        assert "Run: Run number" in api.RunCalibration.__doc__
+        data = api.RunCalibration(DetOId="D_ORCA006", Run=">=5")
+        assert ["apiv2.1.0/RunCalibration/s?&DetOId=D_ORCA006&Run>=5"] == data
+        with self.assertRaises(AttributeError):
+            api.Foo
+        assert "container" in str(inspect.signature(api.RunCalibration))
+        with self.assertRaises(AttributeError):
+            api._foo
+
+    @patch("km3db.core.DBManager")
+    def test_containers(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        data = [{"Run": 1, "Type": "PMT_T0"}, {"Run": 2, "Type": None}]
+
+        def get(url, binary=False, deadline=None):
+            if url == "apiv2.1.0/":
+                return self.catalog.encode()
+            return json.dumps({"Error": {"Code": "OK"}, "Data": data}).encode()
+
+        db.get.side_effect = get
+        api = APIv2(container="np")
+        arr = api.RunCalibration(Run=1)
+        assert ("Run", "Type") == arr.dtype.names
+        assert np.int64 == arr.dtype["Run"]
+        assert ["PMT_T0", ""] == arr["Type"].tolist()
+        df = api.RunCalibration(Run=1, container="pd")
+        assert [1, 2] == df["Run"].tolist()
+        assert data == APIv2().RunCalibration(Run=1)
+
+    @patch("km3db.core.DBManager")
+    def test_batch(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        error = {"Code": "ERR", "Message": "unknown run", "Arguments": []}
+
+        def get(url, binary=False, deadline=None):
+            if url == "apiv2.1.0/":
+                return self.catalog.encode()
+            if url.endswith("Run=3"):
+                return json.dumps({"Error": error, "Data": None}).encode()
+            if url.endswith("Run=4"):
+                return None
+            time.sleep(0.01 * (10 - int(url[-1])))
+            run = int(url[-1])
+            data = [{"Run": run, "Type": "PMT_T0"}]
+            return json.dumps({"Error": {"Code": "OK"}, "Data": data}).encode()
+
+        db.get.side_effect = get
+        api = APIv2(max_workers=3)
+        selectors = [dict(Run=run) for run in range(1, 7)]
+        results = api.batch("RunCalibration", selectors)
+        assert selectors == [result.selectors for result in results]
+        db.grow_pool.assert_called_once_with(3)
+        assert [[{"Run": 1, "Type": "PMT_T0"}]] == [results[0].data]
+        assert [1, 2, None, None, 5, 6] == [
+            r.data[0]["Run"] if r.data else None for r in results
+        ]
+        assert "unknown run" in str(results[2].error)
+        assert isinstance(results[3].error, ValueError)
+        assert [None, None] == [results[0].error, results[5].error]
+        arrays = api.batch("RunCalibration", selectors[:2], container="np")
+        assert [[1], [2]] == [result.data["Run"].tolist() for result in arrays]
+        with self.assertRaises(AttributeError):
+            api.batch("Foo", selectors)
+
+    @patch("km3db.core.DBManager")
+    def test_iter(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.side_effect = self.get
+        data = [{"Run": run, "Type": "PMT_T0"} for run in range(10)]
+        content = json.dumps({"Error": {"Code": "OK"}, "Data": data}).encode()
+        db.open.return_value = io.BytesIO(content)
+        api = APIv2()
+        assert data == list(api.iter("RunCalibration", chunk_size=7, Run=">=0"))
+        db.open.assert_called_once_with(
+            "apiv2.1.0/RunCalibration/s?&Run>=0", deadline=None
+        )
+        db.open.return_value = io.BytesIO(content)
+        batches = list(api.iter("RunCalibration", batch_size=4))
+        assert [4, 4, 2] == [len(batch) for batch in batches]
+
+    @patch("km3db.core.DBManager")
+    def test_iter_error(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.side_effect = self.get
+        error = {"Code": "ERR", "Message": "foo", "Arguments": []}
+        db.open.return_value = io.BytesIO(
+            json.dumps({"Error": error, "Data": [1, 2]}).encode()
+        )
+        assert [] == list(APIv2().iter("RunCalibration"))
+        db.open.return_value = io.BytesIO(b'{"Data": [1, 2')
+        with self.assertRaises(ValueError):
+            list(APIv2().iter("RunCalibration"))
+        assert [] == list(APIv2().iter("Foo"))
+
+
+class TestToColumns(unittest.TestCase):
+    data = [
+        {"Run": 1, "Type": "PMT_T0", "Value": 0.5, "Valid": True, "Extra": "a"},
+        {"Run": None, "Type": None, "Value": 2, "Valid": False, "Extra": None},
+    ]
+
+    def test_schema(self):
+        schema = _extract_schema(["Run -> Integer", "Value -> Double", "Id -> String"])
+        assert ["Run", "Value", "Id"] == list(schema)
+        columns = tocolumns(self.data, schema)
+        assert ["Run", "Value", "Id", "Type", "Valid", "Extra"] == list(columns)
+        assert np.float64 == columns["Run"].dtype
+        assert np.isnan(columns["Run"][1])
+        assert [0.5, 2.0] == columns["Value"].tolist()
+        assert ["", ""] == columns["Id"].tolist()
+        assert ["PMT_T0", ""] == columns["Type"].tolist()
+        assert bool == columns["Valid"].dtype
+        schema = _extract_schema([{"Name": "Run", "Type": "Integer"}])
+        columns = tocolumns([{"Run": 1}, {"Run": 2}], schema)
+        assert np.int64 == columns["Run"].dtype
+
+    def test_type_inference(self):
+        columns = tocolumns([{"a": 1, "b": 1.5, "c": "1"}, {"a": 2, "b": 2, "c": "x"}])
+        assert np.int64 == columns["a"].dtype
+        assert np.float64 == columns["b"].dtype
+        assert ["1", "x"] == columns["c"].tolist()
+        assert [1.0, 2.5] == tocolumns([{"a": 1}, {"a": 2.5}])["a"].tolist()
+
+    def test_empty(self):
+        columns = tocolumns([], _extract_schema(["Run -> Integer"]))
+        assert np.int64 == columns["Run"].dtype
+        assert 0 == len(tonumpy_columns(columns))
+
+    def test_structured_array(self):
+        arr = tonumpy_columns(tocolumns(self.data))
+        assert ("Run", "Type", "Value", "Valid", "Extra") == arr.dtype.names
+        assert 2 == len(arr)
+
+
+class TestJSONDSOffline(unittest.TestCase):
+    @patch("km3db.core.get_db_manager")
+    def test_custom_db_manager(self, get_db_manager_mock):
+        db = DBManager()
+        content = b'{"Result": "OK", "Data": [1]}'
+        with patch.object(db, "get", return_value=content) as get:
+            assert [1] == JSONDS(db=db).get("foo")
+        get.assert_called_once_with("jsonds/foo", binary=True, deadline=None)
+        get_db_manager_mock.assert_not_called()
+
+    @patch("km3db.core.DBManager")
+    def test_iter(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        content = {"Comment": None, "Data": [{"a": 1.5}, {"a": 2}], "Result": "OK"}
+        db.open.return_value = io.BytesIO(json.dumps(content, indent=2).encode())
+        assert content["Data"] == list(JSONDS().iter("foo", chunk_size=3))
+        db.open.assert_called_once_with("jsonds/foo", deadline=None)
+        db.open.return_value = io.BytesIO(b'{"Result": "OK", "Data": {"a": 1}}')
+        assert [{"a": 1}] == list(JSONDS().iter("foo"))
+
+    @patch("km3db.core.DBManager")
+    def test_iter_error(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.open.return_value = io.BytesIO(b'{"Result": "ERROR", "Data": [1]}')
+        with self.assertRaises(ValueError):
+            list(JSONDS().iter("foo"))
+        db.open.return_value = io.BytesIO(b'{"Data": [1], "Result": "ERROR"}')
+        with self.assertRaises(ValueError):
+            list(JSONDS().iter("foo"))
+
+
+class TestJSONCodec(unittest.TestCase):
+    def tearDown(self):
+        jsoncodec.use()
+
+    def test_backends(self):
+        obj = {"a": [1, 2.5, "ü", None, True]}
+        for backend in ("json", "orjson"):
+            if backend == "orjson" and importlib.util.find_spec("orjson") is None:
+                continue
+            jsoncodec.use(backend)
+            assert backend == jsoncodec.backend
+            encoded = jsoncodec.dumps(obj)
+            assert isinstance(encoded, bytes)
+            assert obj == jsoncodec.loads(encoded)
+            assert obj == jsoncodec.loads(encoded.decode())
+            with self.assertRaises(jsoncodec.JSONDecodeError):
+                jsoncodec.loads(b"{")
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            jsoncodec.use("foo")
+
+    def test_runsummary_upload_payload(self):
+        from km3db.cli.streamds import convert_runsummary_to_json
+        import pandas as pd
+
+        df = pd.DataFrame(
+            {
+                "det_id": [49, 49, 49],
+                "run": [1, 2, 3],
+                "source": ["a", "b", "c"],
+                "x": [1.5, float("nan"), float("inf")],
+            }
+        )
+        payloads = set()
+        for backend in ("json", "orjson"):
+            if backend == "orjson" and importlib.util.find_spec("orjson") is None:
+                continue
+            jsoncodec.use(backend)
+            payloads.add(convert_runsummary_to_json(df))
+        assert 1 == len(payloads)
+        payload = json.loads(payloads.pop())
+        runs = payload["Data"][0]["Runs"]
+        assert [1.5, None, None] == [r["Parameters"][0]["Data"][0]["D"] for r in runs]
+
+    @patch("km3db.core.DBManager")
+    def test_jsonds_decodes_bytes(self, db_manager_mock):
+        db = db_manager_mock.return_value
+        db.get.return_value = b'{"Result": "OK", "Data": {"a": "\xc3\xbc"}}'
+        assert {"a": "ü"} == JSONDS().get("foo")
+        db.get.assert_called_once_with("jsonds/foo", binary=True, deadline=None)
+
 
 class TestCLBMapOffline(unittest.TestCase):
     @patch("km3db.tools.StreamDS")
@@ -112,9 +1086,10 @@ class TestCLBMapOffline(unittest.TestCase):
         streamds_mock_obj = streamds_mock.return_value
         with open(data_path("db/clbmap.txt"), "r") as fobj:
             streamds_mock_obj.get.return_value = tonamedtuples(
-                "CLB", fobj.read(), renamemap=CLBMap.renamemap
+                "CLB", fobj.read(), renamemap=CLBMap.renamemap, compact=True
             )
         self.clbmap = CLBMap("a")
+        streamds_mock.assert_called_once_with(container="records")
 
     def test_length(self):
         assert 57 == len(self.clbmap)